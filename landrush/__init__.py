@@ -1,5 +1,9 @@
 import os
-import sqlite3
+import json
+import time
+import heapq
+from itertools import chain, islice
+from datetime import datetime
 from random import randint
 
 from flask import (
@@ -11,24 +15,50 @@ from flask import (
     redirect,
     url_for,
     make_response,
+    session,
+    abort,
+    jsonify,
 )
 import wtforms  # type: ignore
-import aiosql  # type: ignore
 import jinja2
 
+from landrush import storage
 from landrush.model import Game, Player
+import landrush.stats as stats
+import landrush.boardpool as boardpool
+import landrush.events as events
+import landrush.lease as lease
+import landrush.profiling as profiling
+from landrush.writer import write, commit, get_writer
+from landrush.caching import (
+    static_page,
+    static_url,
+    set_static_cache_headers,
+    cached_response,
+    PageCache,
+    GAME_PAGE_MAX_AGE,
+)
 
 app = Flask(__name__)
 app.config.from_mapping(SECRET_KEY="dev")
 DB_PATH = os.path.join(app.instance_path, "main.sqlite3")
 APP_ROOT = os.path.dirname(os.path.abspath(__file__))
-queries = aiosql.from_path(
-    APP_ROOT + "/schema.sql",
-    "sqlite3",
+queries = storage.load_queries(
+    "schema.sql",
     record_classes=dict(
         game=Game,
     ),
 )
+backend = storage.create_backend(DB_PATH)
+
+
+app.add_template_global(static_url)
+app.after_request(set_static_cache_headers)
+RULES_PATH = os.path.join(APP_ROOT, "templates/markdown/rules.html")
+# Clients allowed to see /admin/*, comma separated. Behind nginx, this is the
+# address of the client, not of nginx (see uwsgi_params).
+ADMIN_ADDRESSES = os.environ.get("LANDRUSH_ADMIN_ADDRESSES", "127.0.0.1,::1").split(",")
+spectator_pages = PageCache()
 
 
 @app.template_filter("money")
@@ -36,30 +66,37 @@ def money(m):
     return "" if isinstance(m, jinja2.Undefined) else "%d" % m
 
 
+def create_schema(shard, db):
+    with db:
+        shard.lock_schema(db)
+        queries.create_schema(db)
+        stats.queries.create_schema(db)
+        boardpool.queries.create_schema(db)
+        events.queries.create_schema(db)
+        lease.queries.create_schema(db)
+        shard.create_schema(db)
+
+
 @app.before_request
 def get_db():
     db = getattr(g, "db", None)
     if db is None:
-        db = g.db = sqlite3.connect(DB_PATH)
-        db.execute("PRAGMA foreign_keys = ON")
-        if not db.execute(
-            "SELECT name from sqlite_master WHERE type='table' AND name='game'"
-        ).fetchone():
-            with db:
-                queries.create_schema(db)
-        g.next_game_id = (
-            db.execute("SELECT coalesce(max(game_id), 0) FROM game").fetchall()[0][0]
-            + 1
-        )
-
-
-@app.after_request
-def close_connection(response):
-    db = getattr(g, "db", None)
+        db = g.db = backend.connect()
+        g.storage = backend
+        if not backend.has_table(db, "group_games"):
+            # main shard last, others only check it for the tables
+            for shard in reversed(backend.shards):
+                create_schema(shard, storage.connection(shard))
+
+
+@app.teardown_request
+def close_connection(exception):
+    # also runs after errors, unlike after_request
+    storage.release_game_locks()
+    storage.release_connections()
+    db = g.pop("db", None)
     if db is not None:
-        db.close()
-
-    return response
+        backend.release(db)
 
 
 auction_order_labels = dict(
@@ -80,12 +117,19 @@ class NewGameForm(wtforms.Form):
     name = wtforms.StringField("Game name")
     players = wtforms.SelectField(
         "Number of Players",
-        choices=[(i, i) for i in range(2, 11)],
+        choices=[(i, i) for i in list(range(2, 11)) + [15, 20, 30, 40, 50]],
         default=4,
         coerce=int,
         description="If you start the game with fewer players, AI players "
         "will take the remaining seats.",
     )
+    board_size = wtforms.SelectField(
+        "Board Size",
+        choices=[("normal", "Normal"), ("large", "Large")],
+        default="normal",
+        description="Large boards auction one land per player and turn. "
+        "Recommended for games with many players.",
+    )
     start_money = wtforms.SelectField(
         "Starting Money for each Player",
         choices=[(x, str(x)) for x in [200, 350, 500, 700, 1000, 1500]],
@@ -129,9 +173,68 @@ class NewGameForm(wtforms.Form):
     )
 
 
+def load_player_data(game):
+    """Apply bids and notification settings, which are stored separately"""
+    players = {p.secret: p for p in game.players}
+    db = storage.game_db(game.game_id)
+    for player_secret, bids in queries.get_bids(
+        db, game_id=game.game_id, turn=game.turn
+    ):
+        bids = json.loads(bids)
+        # bids of the wrong length were accepted before they were checked
+        if player_secret in players and len(bids) == len(game.auction):
+            players[player_secret].bids = bids
+    for player_secret, email, notify in queries.get_notification_settings(
+        db, game_id=game.game_id
+    ):
+        if player_secret in players:
+            players[player_secret].email = email
+            players[player_secret].notify = notify
+
+
+def save_game(game, resolved_only=False):
+    """Store the game, commit when done
+
+    Set `resolved_only` if the game has only changed by resolving turns. These
+    are in the event log already, so the pickled state is only rewritten
+    every SNAPSHOT_INTERVAL turns and `get_game` applies the events since.
+    """
+    game.version += 1
+    spectator_pages.invalidate(game.game_id)
+    if (
+        resolved_only
+        and game.status == "in_progress"
+        and game.turn % events.SNAPSHOT_INTERVAL
+    ):
+        write(queries.save_game_progress, **game.as_db_dict(with_state=False))
+    else:
+        write(queries.save_game, **game.as_db_dict())
+    write(queries.delete_old_bids, game_id=game.game_id, turn=game.turn)
+    if game.turn == 0:
+        # players only join before the first auction
+        for p in game.players:
+            write(queries.add_player, game_id=game.game_id, player_secret=p.secret)
+    commit()
+
+
+def is_player(game_id, player_secret):
+    if not player_secret:
+        return False
+    db = storage.game_db(game_id)
+    secrets = {row[0] for row in queries.get_player_secrets(db, game_id=game_id)}
+    if not secrets:
+        # game saved before the secrets were stored in game_player
+        game = queries.get_game(db, game_id=game_id)
+        secrets = {p.secret for p in game.players} if game else set()
+    return int(player_secret) in secrets
+
+
 def get_game(game_id, player_secret):
-    game = queries.get_game(g.db, game_id)
+    db = storage.game_db(game_id)
+    game = queries.get_game(db, game_id=game_id)
     assert game
+    events.catch_up(db, game)
+    load_player_data(game)
 
     # Recognize player from URL secret
     if player_secret:
@@ -142,7 +245,28 @@ def get_game(game_id, player_secret):
     return game, player
 
 
+def spectator_cache_key(game_id):
+    """Key for the spectator view of a game, None if it can't be cached"""
+    row = queries.get_game_version(storage.game_db(game_id), game_id=game_id)
+    if row is None:
+        return None
+    version, turn, status, next_auction_time, bids = row
+    if status == "in_progress" and datetime.utcnow() > datetime.utcfromtimestamp(
+        next_auction_time
+    ):
+        # the auction must be resolved before showing the game
+        return None
+    return (int(game_id), version, turn, bids)
+
+
+def spectator_response(body, cache_key):
+    resp = cached_response(body, "-".join(map(str, cache_key)), GAME_PAGE_MAX_AGE)
+    resp.vary.add("Cookie")
+    return resp.make_conditional(request)
+
+
 @app.route("/")
+@static_page
 def index():
     return render_template("index.html")
 
@@ -152,8 +276,7 @@ def new_game():
     if request.method == "POST":
         form = NewGameForm(request.form)
         game = Game.new_game(**form.data)
-        queries.save_game(g.db, **game.as_db_dict())
-        g.db.commit()
+        save_game(game)
         flash(
             "Game created succesfully! Please send the current URL to other "
             "people to allow them to join the game.",
@@ -167,24 +290,46 @@ def new_game():
 @app.route("/game/<game_id>/")
 @app.route("/game/<game_id>/<player_secret>", methods=["POST", "GET"])
 def show_game(game_id, player_secret=None):
-    game, player = get_game(game_id, player_secret)
-
     if request.method == "POST":
-        if int(request.form.get("turn")) != game.turn:
+        # Only store the bids. The auction is resolved when the game page is
+        # shown after the redirect.
+        if not is_player(game_id, player_secret):
+            abort(404)
+        turn = int(request.form.get("turn"))
+        game, _ = get_game(game_id, None)
+        bids = request.form.getlist("bid")
+        if turn != game.turn:
             flash("Too late! The turn has already passed.", "danger")
+        elif len(bids) != len(game.auction):
+            # the auction can't be resolved with these bids
+            abort(400)
         else:
-            bids = request.form.getlist("bid")
-
-            player.bids = [float(b) if b != "" else 0 for b in bids]
-            if game.ready_for_auction:
-                game.resolve_auction()
-
-            queries.save_game(g.db, **game.as_db_dict())
-            g.db.commit()
+            write(
+                queries.save_bids,
+                game_id=game_id,
+                player_secret=int(player_secret),
+                turn=turn,
+                bids=json.dumps([float(b) if b != "" else 0 for b in bids]),
+            )
+            commit()
         return redirect(
             url_for("show_game", game_id=game_id, player_secret=player_secret)
         )
 
+    # Spectators without cookie or pending messages all see the same page
+    cache_key = None
+    if (
+        not player_secret
+        and "game-%s" % game_id not in request.cookies
+        and not session.get("_flashes")
+    ):
+        cache_key = spectator_cache_key(game_id)
+        body = spectator_pages.get(cache_key)
+        if body is not None:
+            return spectator_response(body, cache_key)
+
+    game, player = get_game(game_id, player_secret)
+
     # Redirect to player page if cookie is present
     cookie_secret = request.cookies.get("game-%s" % game_id)
     all_secrets = [p.secret for p in game.players]
@@ -194,22 +339,40 @@ def show_game(game_id, player_secret=None):
         )
 
     game_changed = False
+    resolved_only = True
+    resolving_elsewhere = False
 
-    # Trigger auction if the time is up
+    # Trigger auction if the time is up, see lease.py
     if game.ready_for_auction:
-        game.resolve_auction()
-        game_changed = True
+        holder = lease.acquire(game.game_id, game.turn)
+        if holder:
+            try:
+                # bids might have been placed since loading the game
+                game, player = get_game(game_id, player_secret)
+                game.resolve_auction()
+            except Exception:
+                # nothing is committed, but the others shouldn't wait for it
+                g.pop("writes", None)
+                g.db.rollback()
+                lease.abandon(game.game_id, holder)
+                raise
+            lease.release(game.game_id, holder)
+            game_changed = True
+        elif lease.wait(game.game_id):
+            game, player = get_game(game_id, player_secret)
+        else:
+            resolving_elsewhere = True
 
-    # Show queued messages
-    if player and player.messages:
+    # Show queued messages, unless saving would overwrite the resolved game
+    if player and player.messages and not resolving_elsewhere:
         for m in player.messages:
             flash(*m)
         player.messages = []
         game_changed = True
+        resolved_only = False
 
     if game_changed:
-        queries.save_game(g.db, **game.as_db_dict())
-        g.db.commit()
+        save_game(game, resolved_only)
 
     # Sort players by money if game has finished
     if game.status == "finished":
@@ -222,7 +385,13 @@ def show_game(game_id, player_secret=None):
     )
     ctx.update(game.state)
 
-    resp = make_response(render_template("game.html", **ctx))
+    with profiling.stage("render"):
+        body = render_template("game.html", **ctx)
+    if cache_key and not game_changed:
+        spectator_pages.set(cache_key, body)
+        return spectator_response(body, cache_key)
+
+    resp = make_response(body)
 
     # Set player cookie, so that players get to their game page when using the
     # general game link
@@ -237,10 +406,32 @@ def show_game(game_id, player_secret=None):
     return resp
 
 
+@app.route("/game/<game_id>/replay/<int:turn>")
+def replay_game(game_id, turn):
+    """Show the game as it was at the start of a past turn"""
+    if turn > queries.get_turn(storage.game_db(game_id), game_id=game_id):
+        abort(404)
+    game = events.replay(game_id, turn)
+    if game is None:
+        abort(404)
+
+    ctx = dict(
+        players=game.players,
+        player=None,
+        game=game,
+        auction_order_labels=auction_order_labels,
+    )
+    ctx.update(game.state)
+    return render_template("game.html", **ctx)
+
+
 @app.route("/game/<game_id>/new_player", methods=["POST"])
 def new_player(game_id):
-    game = queries.get_game(g.db, game_id)
-    assert game
+    g.storage.lock_game(storage.game_db(game_id), game_id)
+    game, _ = get_game(game_id, None)
+    if game.status != "new":
+        # e.g. a join form opened before the game started
+        abort(409)
 
     player = Player(request.form["name"] or "Anonymous", game)
     notify_defaults = request.cookies.get("notify-defaults")
@@ -250,8 +441,7 @@ def new_player(game_id):
     if len(game.players) == game.number_of_players:
         game.start()
 
-    queries.save_game(g.db, **game.as_db_dict())
-    g.db.commit()
+    save_game(game)
 
     flash(
         "Joined successfully! Please bookmark this URL "
@@ -266,19 +456,24 @@ def new_player(game_id):
 
 @app.route("/game/<game_id>/<player_secret>/notifications", methods=["POST"])
 def save_notification_settings(game_id, player_secret):
-    game, player = get_game(game_id, player_secret)
-
-    # change settings
-    player.email = request.form["email"]
-    player.notify = request.form["when"]
-    queries.save_game(g.db, **game.as_db_dict())
-    g.db.commit()
+    if not is_player(game_id, player_secret):
+        abort(404)
+    email = request.form["email"]
+    notify = request.form["when"]
+    write(
+        queries.save_notification_settings,
+        game_id=game_id,
+        player_secret=int(player_secret),
+        email=email,
+        notify=notify,
+    )
+    commit()
 
     flash("Notification settings changed successfully", "success")
-    resp = make_response(redirect("/game/%d/%s" % (game.game_id, player.secret)))
+    resp = make_response(redirect("/game/%s/%s" % (game_id, player_secret)))
 
     # change defaults in cookie
-    defaults = "%s|%s" % (player.email, player.notify)
+    defaults = "%s|%s" % (email, notify)
     resp.set_cookie(
         "notify-defaults", defaults, max_age=60 * 60 * 24 * 365 * 10, samesite="Lax"
     )
@@ -288,12 +483,14 @@ def save_notification_settings(game_id, player_secret):
 
 @app.route("/game/<game_id>/<player_secret>/start", methods=["POST"])
 def start_game(game_id, player_secret=None):
-    game = queries.get_game(g.db, game_id)
+    g.storage.lock_game(storage.game_db(game_id), game_id)
+    game, _ = get_game(game_id, None)
+    if game.status != "new":
+        abort(409)
     assert int(player_secret) == game.players[0].secret
 
     game.start()
-    queries.save_game(g.db, **game.as_db_dict())
-    g.db.commit()
+    save_game(game)
 
     return redirect("/game/%d/%s" % (game.game_id, player_secret))
 
@@ -305,8 +502,7 @@ def quick_ai_game():
     player.email, player.notify = "", "turn"
     game.players.append(player)
     game.start()
-    queries.save_game(g.db, **game.as_db_dict())
-    g.db.commit()
+    save_game(game)
     flash(
         "This game has been set up for you to try Land Rush "
         "against AI players. The real fun will be playing against humans.",
@@ -318,33 +514,90 @@ def quick_ai_game():
 
 
 @app.route("/rules")
+@static_page
 def rules():
-    return render_template(
-        "page.html",
-        content=jinja2.Markup(
-            open(os.path.dirname(__file__) + "/templates/markdown/rules.html").read()
-        ),
+    with open(RULES_PATH) as f:
+        return render_template("page.html", content=jinja2.Markup(f.read()))
+
+
+def get_games_by_status(status, limit):
+    """Latest games from all shards, in the order of the query"""
+    games = heapq.merge(
+        *storage.all_shards(queries.get_games_by_status, status=status, limit=limit),
+        key=lambda game: (game.finished_at or datetime.min, game.created_at),
+        reverse=True,
     )
+    return list(islice(games, limit))
 
 
 @app.route("/list_games")
 def list_games():
-    open_games = queries.get_open_games(g.db)
+    open_games = list(
+        chain.from_iterable(
+            storage.all_shards(queries.get_open_games, now=int(time.time()))
+        )
+    )
     if not open_games:
         name = "Newbies %d" % randint(1000, 9999)
         game = Game.new_game(name, public=True)
-        queries.save_game(g.db, **game.as_db_dict())
-        g.db.commit()
+        save_game(game)
         open_games = [game]
 
     ctx = {
         "open_games": open_games,
-        "games_in_progress": queries.get_games_by_status(
-            g.db, status="in_progress", limit=100
-        ),
-        "finished_games": queries.get_games_by_status(
-            g.db, status="finished", limit=10
-        ),
+        "games_in_progress": get_games_by_status("in_progress", limit=100),
+        "finished_games": get_games_by_status("finished", limit=10),
     }
 
     return render_template("list_games.html", **ctx)
+
+
+@app.route("/leaderboard")
+def leaderboard():
+    return render_template(
+        "leaderboard.html",
+        auction_order_labels=auction_order_labels,
+        **stats.leaderboard(),
+    )
+
+
+@app.after_request
+def finish_memory_profile(response):
+    if profiling.ENABLED:
+        # not the path, it contains player secrets
+        rule = request.url_rule.rule if request.url_rule else None
+        profiling.request_finished(rule)
+    return response
+
+
+@app.before_request
+def check_admin_access():
+    if (
+        request.path.startswith("/admin/")
+        and request.remote_addr not in ADMIN_ADDRESSES
+    ):
+        abort(404)
+
+
+@app.route("/admin/memory")
+def memory_profile():
+    if not profiling.ENABLED:
+        abort(404)
+    return jsonify(profiling.report())
+
+
+@app.route("/admin/leases")
+def lease_metrics():
+    return jsonify(lease.metrics())
+
+
+@app.route("/admin/writer")
+def writer_metrics():
+    if not g.storage.group_commit:
+        abort(404)
+    return jsonify(
+        {
+            os.path.basename(shard.path): get_writer(shard.path).metrics()
+            for shard in g.storage.shards
+        }
+    )
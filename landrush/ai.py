@@ -1,7 +1,11 @@
 from __future__ import division
+import os
 import random
+import time
 import string
 
+import landrush.montecarlo as montecarlo
+
 adjectives = (
     "electronic automatic binary numeric mechanic robotic programmed "
     "mechanized electric"
@@ -11,32 +15,63 @@ names = (
 ).split(" ")
 
 
-def player_name():
-    adj = random.choice(adjectives)
-    name = random.choice(names)
+def player_name(rng=random):
+    adj = rng.choice(adjectives)
+    name = rng.choice(names)
     return string.capwords(adj + " " + name)
 
 
-def calc_bid_for_land(game, player, land):
+def bid_context(game, player):
+    """Values needed by `calc_bid_for_land` which are equal for all lands"""
     base_price = game.remaining_payout / len(game.board.lands)
+    if not player.lands:
+        return base_price, None
+
+    islands = player.islands()
+    max_island_size = max(len(i) for i in islands)
+    largest_islands = [i for i in islands if len(i) == max_island_size]
+    return base_price, set().union(*largest_islands)
+
 
-    if player.lands:
-        islands = player.islands()
-        max_island_size = max(len(i) for i in islands)
-        largest_islands = [i for i in islands if len(i) == max_island_size]
-        lands_in_largest_islands = set().union(*largest_islands)
+def calc_bid_for_land(game, player, land, context=None):
+    base_price, lands_in_largest_islands = context or bid_context(game, player)
+
+    if lands_in_largest_islands is not None:
         connected_to_largest_island = bool(land.neighbors & lands_in_largest_islands)
         base_factor = 0.5 if connected_to_largest_island else 0.1
     else:
         base_factor = 0.5
 
-    neighbors_factor = sum(
-        0.15 if n.owner == player else 0.3 if n.owner is None else 0
-        for n in land.neighbors
-    )
+    # count first, so that the result does not depend on the set order
+    own_neighbors = sum(n.owner == player for n in land.neighbors)
+    free_neighbors = sum(n.owner is None for n in land.neighbors)
+    neighbors_factor = 0.15 * own_neighbors + 0.3 * free_neighbors
     spending_factor = player.money / game.start_money
     return round(base_price * (base_factor + neighbors_factor) * spending_factor)
 
 
 def calculate_bids(game, player):
-    return [calc_bid_for_land(game, player, land) for land in game.auction]
+    context = bid_context(game, player)
+    return [calc_bid_for_land(game, player, land, context) for land in game.auction]
+
+
+def calculate_bids_for_players(game, players):
+    """Bids for all AI controlled players of this turn
+
+    If LANDRUSH_AI_TIME_BUDGET is set, the Monte Carlo AI improves the bids of
+    players who are still in the game. All bids are then calculated within
+    that many seconds, plus `montecarlo.GRACE_TIME`.
+    """
+    time_budget = float(os.environ.get("LANDRUSH_AI_TIME_BUDGET", 0))
+    deadline = time.time() + time_budget
+    bids = [calculate_bids(game, p) for p in players]
+    active = [i for i, p in enumerate(players) if not p.quit]
+    if time_budget <= 0 or not active or not game.auction:
+        return bids
+
+    improved_bids = montecarlo.calculate_bids(
+        game, [players[i] for i in active], [bids[i] for i in active], deadline
+    )
+    for i, player_bids in zip(active, improved_bids):
+        bids[i] = player_bids
+    return bids
@@ -0,0 +1,46 @@
+import numpy as np
+
+
+def resolve(bids, money, auction_type, seed):
+    """Determine winners and prices for all lands of an auction at once
+
+    `bids` is a (players x lands) matrix and `money` the players' money
+    before the auction. Lands are sold in column order, and bids are reduced
+    to the money a player has left when the land is sold. Ties are broken by
+    a random player order per land, which is deterministic for a given seed.
+
+    Returns the reduced bids, the winner index and the price for each land.
+    """
+    bids = np.array(bids, dtype=float).reshape(len(money), -1)
+    money = np.array(money, dtype=float)
+    priority = np.random.default_rng(seed).random(bids.shape)
+
+    if (np.maximum(bids, 0).sum(axis=1) <= money).all():
+        # Nobody can run out of money during this auction, so all lands can
+        # be resolved in one pass.
+        bids = np.minimum(bids, money[:, None])
+        winners, prices = _winners_and_prices(bids, priority, auction_type)
+    else:
+        winners = np.empty(bids.shape[1], dtype=int)
+        prices = np.empty(bids.shape[1])
+        for i in range(bids.shape[1]):
+            bids[:, i] = np.minimum(bids[:, i], money)
+            w, p = _winners_and_prices(
+                bids[:, i : i + 1], priority[:, i : i + 1], auction_type
+            )
+            winners[i], prices[i] = w[0], p[0]
+            money[w[0]] -= p[0]
+
+    return bids, winners, prices
+
+
+def _winners_and_prices(bids, priority, auction_type):
+    highest = bids.max(axis=0)
+    winners = np.where(bids == highest, priority, -1).argmax(axis=0)
+    if auction_type == "1st_price":
+        prices = highest
+    elif auction_type == "2nd_price":
+        prices = np.sort(bids, axis=0)[-2]
+    else:
+        raise Exception("Unknown auction type")
+    return winners, prices
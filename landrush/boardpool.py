@@ -0,0 +1,64 @@
+"""Boards generated in the background, ready for new games"""
+
+import pickle
+import random
+import threading
+
+from flask import g
+
+from landrush import storage
+from landrush.field import Board
+from landrush.writer import COMMIT_TIMEOUT, execute, get_writer
+
+# Refill the pool for a board size when fewer boards are left ...
+LOW_WATERMARK = 3
+# ... up to this number of boards
+HIGH_WATERMARK = 10
+
+queries = storage.load_queries("boardpool.sql")
+_refilling: set = set()
+_refilling_lock = threading.Lock()
+
+
+def get_board(size, joins):
+    """Take a board from the pool, generate one if the pool is empty"""
+    params = dict(x_size=size[0], y_size=size[1], joins=joins)
+    row = execute(queries.take_board, **params)
+    if queries.count_boards(g.db, **params) < LOW_WATERMARK:
+        start_refill(g.storage, size, joins)
+
+    if row is None:
+        return Board(size=size, joins=joins)
+    return pickle.loads(bytes(row[0]))
+
+
+def start_refill(backend, size, joins):
+    key = (backend, size, joins)
+    with _refilling_lock:
+        if key in _refilling:
+            return
+        _refilling.add(key)
+    threading.Thread(target=refill, args=key, daemon=True).start()
+
+
+def refill(backend, size, joins):
+    params = dict(x_size=size[0], y_size=size[1], joins=joins)
+    try:
+        db = backend.connect()
+        try:
+            while queries.count_boards(db, **params) < HIGH_WATERMARK:
+                board = pickle.dumps(Board(size=size, joins=joins))
+                insert = dict(board_id=random.getrandbits(62), board=board, **params)
+                if backend.group_commit:
+                    # SQLite writes must go through the writer thread
+                    writer = get_writer(backend.main.path)
+                    future = writer.submit([(queries.add_board, insert)])
+                    future.result(timeout=COMMIT_TIMEOUT)
+                else:
+                    with db:
+                        queries.add_board(db, **insert)
+        finally:
+            backend.release(db)
+    finally:
+        with _refilling_lock:
+            _refilling.remove((backend, size, joins))
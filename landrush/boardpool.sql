@@ -0,0 +1,35 @@
+-- name: create-schema#
+-- Boards generated in advance, so that creating a game is only a lookup
+CREATE TABLE IF NOT EXISTS board_pool(
+    board_id BIGINT PRIMARY KEY,  -- random
+    x_size INT NOT NULL,
+    y_size INT NOT NULL,
+    joins INT NOT NULL,
+    board BYTEA NOT NULL  -- pickled
+);
+CREATE INDEX IF NOT EXISTS board_pool_size ON board_pool(x_size, y_size, joins);
+
+
+-- name: take_board^
+DELETE FROM board_pool
+WHERE board_id = (
+    SELECT min(board_id)
+    FROM board_pool
+    WHERE x_size = :x_size
+      AND y_size = :y_size
+      AND joins = :joins
+)
+RETURNING board
+
+
+-- name: count_boards$
+SELECT count(*)
+FROM board_pool
+WHERE x_size = :x_size
+  AND y_size = :y_size
+  AND joins = :joins
+
+
+-- name: add_board!
+INSERT INTO board_pool(board_id, x_size, y_size, joins, board)
+VALUES(:board_id, :x_size, :y_size, :joins, :board)
@@ -0,0 +1,117 @@
+import os
+import hashlib
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache, wraps
+
+from flask import current_app as app, request, make_response, url_for
+
+# Static URLs contain a content hash, so they can be cached forever
+STATIC_MAX_AGE = 60 * 60 * 24 * 365
+# Pages are revalidated after this time, which is cheap thanks to the ETag
+PAGE_MAX_AGE = 60 * 10
+# Proxies may show a game to spectators for this long without revalidating
+GAME_PAGE_MAX_AGE = 5
+
+_page_cache: dict = {}
+_content_mtime = None
+
+
+@lru_cache(maxsize=None)
+def _file_hash(path, mtime):
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()[:12]
+
+
+def static_url(filename):
+    """URL for a static file which changes whenever the file content changes"""
+    path = os.path.join(app.static_folder, filename)
+    return url_for(
+        "static", filename=filename, v=_file_hash(path, os.path.getmtime(path))
+    )
+
+
+def content_mtime():
+    """Last modification of any template or static file
+
+    Files only change on deployment, which restarts the app, so they are
+    only checked once. In debug mode they are checked on every call.
+    """
+    global _content_mtime
+    if _content_mtime is None or app.debug:
+        _content_mtime = _scan_mtime()
+    return _content_mtime
+
+
+def _scan_mtime():
+    mtime = 0.0
+    template_folder = os.path.join(app.root_path, app.template_folder)
+    for folder in [template_folder, app.static_folder]:
+        for root, dirs, files in os.walk(folder):
+            for name in files:
+                mtime = max(mtime, os.path.getmtime(os.path.join(root, name)))
+    return mtime
+
+
+def static_page(view):
+    """Cache a page whose content only depends on templates and static files
+
+    The rendered page is kept in memory until one of those changes and is sent
+    with validators, so that browsers and proxies can reuse their copy.
+    """
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        mtime = content_mtime()
+        key = (request.endpoint, mtime)
+        if key not in _page_cache:
+            body = view(*args, **kwargs)
+            _page_cache[key] = (body, hashlib.md5(body.encode()).hexdigest())
+        body, etag = _page_cache[key]
+
+        response = cached_response(body, etag, PAGE_MAX_AGE)
+        response.last_modified = datetime.utcfromtimestamp(int(mtime))
+        return response.make_conditional(request)
+
+    return wrapper
+
+
+def cached_response(body, etag, max_age):
+    response = make_response(body)
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response
+
+
+class PageCache:
+    """The most recently used rendered pages, keyed by (game_id, ...) tuples"""
+
+    def __init__(self, size=256):
+        self.size = size
+        self.pages: OrderedDict = OrderedDict()
+
+    def get(self, key):
+        body = self.pages.get(key)
+        if body is not None:
+            self.pages.move_to_end(key)
+        return body
+
+    def set(self, key, body):
+        self.pages[key] = body
+        self.pages.move_to_end(key)
+        while len(self.pages) > self.size:
+            self.pages.popitem(last=False)
+
+    def invalidate(self, game_id):
+        for key in [k for k in self.pages if k[0] == game_id]:
+            del self.pages[key]
+
+
+def set_static_cache_headers(response):
+    """Allow caching static files forever if they are requested by content hash"""
+    if request.endpoint == "static" and "v" in request.args:
+        response.headers["Cache-Control"] = (
+            "public, max-age=%d, immutable" % STATIC_MAX_AGE
+        )
+    return response
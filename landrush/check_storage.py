@@ -0,0 +1,85 @@
+"""Play games against the configured database to check the backend
+
+Run against an empty database, e.g. a local PostgreSQL with
+
+    LANDRUSH_DATABASE_URL=postgresql://postgres@localhost/landrush_check \\
+        python -m landrush.check_storage
+
+Each thread plays a quick AI game through the Flask test client, bidding
+every turn until the game has finished, then the game lists and the
+leaderboard are loaded. By default there are more threads than PostgreSQL
+connections, so requests have to wait for a free connection. The games and
+statistics are left in the database.
+"""
+
+import re
+import time
+import argparse
+import threading
+
+from landrush import app, storage
+
+MAX_TURNS = 100
+
+
+def play_game():
+    client = app.test_client()
+    resp = client.get("/quick_ai_game")
+    assert resp.status_code == 302, "/quick_ai_game: %d" % resp.status_code
+    url = resp.location
+    for i in range(MAX_TURNS):
+        resp = client.get(url)
+        assert resp.status_code == 200, "%s: %d" % (url, resp.status_code)
+        html = resp.get_data(as_text=True)
+        turn = re.search(r'name="turn" value="(\d+)"', html)
+        if not turn:
+            return
+        bids = ["5"] * html.count('name="bid"')
+        resp = client.post(url, data=dict(turn=turn.group(1), bid=bids))
+        assert resp.status_code == 302, "%s: %d" % (url, resp.status_code)
+    raise AssertionError("%s not finished after %d turns" % (url, MAX_TURNS))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--threads", type=int, default=30)
+    args = parser.parse_args()
+
+    errors: list = []
+
+    def run():
+        try:
+            play_game()
+        except Exception as e:
+            errors.append(e)
+
+    start_time = time.time()
+    threads = [threading.Thread(target=run) for i in range(args.threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    for e in errors:
+        print("%s: %s" % (type(e).__name__, e))
+    print(
+        "%d of %d games played with %s in %.1fs"
+        % (
+            args.threads - len(errors),
+            args.threads,
+            storage.DRIVER,
+            time.time() - start_time,
+        )
+    )
+
+    client = app.test_client()
+    for url in ["/list_games", "/leaderboard"]:
+        status = client.get(url).status_code
+        print("%s: %d" % (url, status))
+        if status != 200:
+            errors.append(url)
+    if errors:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Play random games with two engines and compare them turn by turn
+
+An engine replaces some of the functions which decide how a game turns out
+(see HOOKS) with other implementations. Each game is played with both
+engines from the same pickled start, and the games must be equal after
+every turn. The time spent resolving turns is summed up for each engine.
+
+Run with `python -m landrush.compare_engines`. By default the current code
+is compared against the simple implementations in REFERENCE. Pass
+`--engine module:attribute` to compare against a dict of your own.
+"""
+
+import os
+import sys
+import time
+import pickle
+import random
+import argparse
+import importlib
+from contextlib import contextmanager
+
+import numpy as np
+from flask import g
+
+import landrush.ai as ai
+import landrush.auction as auction
+from landrush import app, create_schema, storage
+from landrush.model import Game, Player
+
+# name -> (object, attribute) which an engine can replace
+HOOKS = {
+    "resolve": (auction, "resolve"),
+    "make_auction": (Game, "make_auction"),
+    "islands": (Player, "islands"),
+    "calculate_bids": (ai, "calculate_bids"),
+}
+
+
+def resolve(bids, money, auction_type, seed):
+    """`auction.resolve`, one land and one player at a time"""
+    bids = [list(map(float, player_bids)) for player_bids in bids]
+    money = list(map(float, money))
+    priority = np.random.default_rng(seed).random((len(money), len(bids[0])))
+    winners, prices = [], []
+    for i in range(len(bids[0])):
+        for p in range(len(money)):
+            bids[p][i] = min(bids[p][i], money[p])
+        ranking = sorted(
+            range(len(money)), key=lambda p: (bids[p][i], priority[p][i]), reverse=True
+        )
+        winner = ranking[0]
+        if auction_type == "1st_price":
+            price = bids[winner][i]
+        else:
+            price = sorted(bids[p][i] for p in range(len(money)))[-2]
+        money[winner] -= price
+        winners.append(winner)
+        prices.append(price)
+    return np.array(bids), np.array(winners), np.array(prices)
+
+
+def islands(player):
+    """`Player.islands` by flood fill"""
+    lands = player.lands
+    islands = set()
+    while lands:
+        island = {lands.pop()}
+        todo = list(island)
+        while todo:
+            for n in todo.pop().neighbors & lands:
+                lands.remove(n)
+                island.add(n)
+                todo.append(n)
+        islands.add(frozenset(island))
+    return islands
+
+
+def calculate_bids(game, player):
+    """`ai.calculate_bids` without sharing work between lands"""
+    return [ai.calc_bid_for_land(game, player, land) for land in game.auction]
+
+
+REFERENCE = dict(resolve=resolve, islands=islands, calculate_bids=calculate_bids)
+
+
+@contextmanager
+def use_engine(engine):
+    originals = {}
+    for name, implementation in engine.items():
+        obj, attr = HOOKS[name]
+        originals[name] = getattr(obj, attr)
+        setattr(obj, attr, implementation)
+    try:
+        yield
+    finally:
+        for name, implementation in originals.items():
+            obj, attr = HOOKS[name]
+            setattr(obj, attr, implementation)
+
+
+def random_game(rng):
+    players = rng.randint(2, 10)
+    game = Game.new_game(
+        "Game",
+        start_money=rng.choice([100, 500, 1000]),
+        auction_type=rng.choice(["1st_price", "2nd_price"]),
+        players=players,
+        auction_order=rng.choice(
+            ["random", "go_west", "small_first", "small_last", "connected"]
+        ),
+        board_size="large" if rng.random() < 0.1 else "normal",
+        rng=rng,
+    )
+    for i in range(players):
+        game.players.append(Player(ai.player_name(rng), game, ai=True, rng=rng))
+    game.start()
+    return game
+
+
+def summary(game):
+    """Everything which must not differ between engines"""
+    return dict(
+        turn=game.turn,
+        status=game.status,
+        auction=[l.id for l in game.auction],
+        upcoming_auction=[l.id for l in game.upcoming_auction],
+        last_auction=[(l.id, l.price) for l in game.state["last_auction"]],
+        owners=sorted((l.id, l.owner.id) for l in game.board.lands if l.owner),
+        players=[
+            (p.id, p.money, p.payout, p.connected_lands, p.last_bid_sum, p.quit)
+            for p in game.players
+        ],
+    )
+
+
+def compare_game(seed, engine):
+    """Play one game with both engines, return the time spent by each"""
+    start = pickle.dumps(random_game(random.Random(seed)))
+    games = [pickle.loads(start), pickle.loads(start)]
+    engines = [{}, engine]
+    durations = [0.0, 0.0]
+    while games[0].status != "finished":
+        for i in range(2):
+            with use_engine(engines[i]):
+                start_time = time.perf_counter()
+                games[i].resolve_auction()
+                durations[i] += time.perf_counter() - start_time
+        # nothing is committed
+        g.pop("writes", None)
+
+        expected, actual = map(summary, games)
+        if expected != actual:
+            for key in expected:
+                if expected[key] != actual[key]:
+                    print("Game %d, turn %d: %s differs" % (seed, games[0].turn, key))
+                    print("  current:", expected[key])
+                    print("  engine: ", actual[key])
+            raise SystemExit(1)
+    return durations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--games", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first game")
+    parser.add_argument("--engine", help="module:attribute, default: REFERENCE")
+    args = parser.parse_args()
+    if args.engine:
+        module, attr = args.engine.split(":")
+        engine = getattr(importlib.import_module(module), attr)
+    else:
+        engine = REFERENCE
+
+    # the Monte Carlo AI depends on timing
+    os.environ.pop("LANDRUSH_AI_TIME_BUDGET", None)
+    backend = storage.SQLiteStorage(":memory:")
+    with app.test_request_context():
+        g.storage = backend
+        g.db = backend.connect()
+        create_schema(backend, g.db)
+        totals = [0.0, 0.0]
+        for seed in range(args.seed, args.seed + args.games):
+            for i, duration in enumerate(compare_game(seed, engine)):
+                totals[i] += duration
+            sys.stdout.write("\r%d games equal" % (seed - args.seed + 1))
+            sys.stdout.flush()
+
+    print()
+    print("current: %.2fs, engine: %.2fs" % tuple(totals))
+    print("engine takes %.2fx the time of the current code" % (totals[1] / totals[0]))
+
+
+if __name__ == "__main__":
+    main()
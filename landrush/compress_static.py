@@ -0,0 +1,61 @@
+"""Write precompressed variants of the static files
+
+nginx serves them directly via `gzip_static` and `brotli_static`, see
+uwsgi/landrush.nginx. Run with `python -m landrush.compress_static`.
+"""
+
+import os
+import gzip
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    brotli = None
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+COMPRESSIBLE = (".css", ".js", ".svg", ".html", ".txt")
+
+
+def static_files():
+    for root, dirs, files in os.walk(STATIC_DIR):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            base, ext = os.path.splitext(name)
+            if base + ".min" + ext in files:
+                # only the minified version is served
+                continue
+            yield os.path.join(root, name)
+
+
+def write_if_smaller(path, original, compressed):
+    if len(compressed) < len(original):
+        with open(path, "wb") as f:
+            f.write(compressed)
+        return True
+    if os.path.exists(path):
+        os.remove(path)
+    return False
+
+
+def compress(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    written = []
+    if write_if_smaller(path + ".gz", data, gzip.compress(data, 9, mtime=0)):
+        written.append("gz")
+    if brotli and write_if_smaller(path + ".br", data, brotli.compress(data)):
+        written.append("br")
+    return written
+
+
+def main():
+    if not brotli:
+        print("brotli module not installed: skipping .br files")
+    for path in static_files():
+        written = compress(path)
+        print(os.path.relpath(path, STATIC_DIR), " ".join(written))
+
+
+if __name__ == "__main__":
+    main()
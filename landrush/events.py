@@ -0,0 +1,118 @@
+"""Append-only log of resolved turns
+
+Each resolved turn adds a small JSON event with the bids, land sales, payouts
+and the next auction. Together with full snapshots taken when the game starts
+and every SNAPSHOT_INTERVAL turns, this allows to rebuild the game as it was
+at the start of any turn.
+
+The pickled state in the game table is not rewritten after each turn either,
+see `save_game`. Loading a game applies the events since it was saved.
+"""
+
+import json
+import time
+import pickle
+from datetime import datetime
+
+from landrush import storage
+from landrush.writer import write
+
+SNAPSHOT_INTERVAL = 10
+
+queries = storage.load_queries("events.sql")
+
+
+def save_snapshot(game):
+    write(
+        queries.add_snapshot,
+        game_id=game.game_id,
+        turn=game.turn,
+        game=pickle.dumps(game.as_db_dict()),
+    )
+
+
+def turn_resolved(game, event):
+    """Store the event for the turn before `game.turn`"""
+    write(
+        queries.add_event,
+        game_id=game.game_id,
+        turn=game.turn - 1,
+        event=json.dumps(event, separators=(",", ":")),
+        created_at=int(time.time()),
+    )
+    if game.turn % SNAPSHOT_INTERVAL == 0:
+        save_snapshot(game)
+
+
+def apply(game, event):
+    """Repeat a turn resolved by `Game.resolve_auction`"""
+    players = {p.id: p for p in game.players}
+    lands = {l.id: l for l in game.board.lands}
+
+    for player_id in event["missed_deadline"]:
+        players[player_id].miss_deadline(game.allowed_missed_deadlines)
+
+    game.state["last_auction"] = []
+    for land_id, player_id, price in event["sales"]:
+        land = lands[land_id]
+        players[player_id].money -= price
+        land.owner = players[player_id]
+        land.price = price
+        game.state["last_auction"].append(land)
+
+    for player_id, bids in event["bids"]:
+        players[player_id].last_bid_sum = sum(bids)
+        players[player_id].bids = None
+
+    game.state["auction"] = game.upcoming_auction
+    game.state["upcoming_auction"] = [lands[l] for l in event["upcoming_auction"]]
+    game.next_auction_time = datetime.utcfromtimestamp(event["next_auction_time"])
+
+    for p in game.players:
+        p.update_connected_lands()
+
+    game.players[:] = [players[player_id] for player_id, _ in event["payouts"]]
+    for player_id, payout in event["payouts"]:
+        p = players[player_id]
+        p.payout = payout
+        p.money += payout
+        if p.money <= 0:
+            p.quit = True
+    if not game.auction:
+        game.status = "finished"
+    game.turn += 1
+
+
+def apply_events(db, game, to_turn):
+    """Apply the events from `game.turn` up to the start of `to_turn`"""
+    for event_turn, event in queries.get_events(
+        db, game_id=game.game_id, from_turn=game.turn, to_turn=to_turn
+    ):
+        assert event_turn == game.turn, "missing event for turn %d" % game.turn
+        apply(game, json.loads(event))
+    assert game.turn == to_turn, "missing event for turn %d" % game.turn
+
+
+def catch_up(db, game):
+    """Bring a game loaded from the game table up to its current turn"""
+    turn = game.turn
+    saved_turn = game.state.get("saved_turn", turn)
+    if saved_turn < turn:
+        # only the state is behind, the columns are up to date
+        next_auction_time = game.next_auction_time
+        game.turn = saved_turn
+        apply_events(db, game, turn)
+        game.next_auction_time = next_auction_time
+
+
+def replay(game_id, turn):
+    """The game as it was at the start of `turn`, None if not available"""
+    from landrush.model import Game
+
+    db = storage.game_db(game_id)
+    snapshot = queries.get_snapshot(db, game_id=game_id, turn=turn)
+    if snapshot is None:
+        return None
+    game = Game(**pickle.loads(bytes(snapshot[1])))
+    apply_events(db, game, turn)
+    return game
@@ -0,0 +1,50 @@
+-- name: create-schema#
+-- One compact record per resolved turn, see events.py
+CREATE TABLE IF NOT EXISTS game_event(
+    game_id INT NOT NULL,
+    turn INT NOT NULL,
+    created_at INT NOT NULL,
+    event TEXT NOT NULL,  -- JSON
+    PRIMARY KEY (game_id, turn)
+);
+
+-- Full copies of the game at the start of some turns, to replay from
+CREATE TABLE IF NOT EXISTS game_snapshot(
+    game_id INT NOT NULL,
+    turn INT NOT NULL,
+    game BYTEA NOT NULL,  -- pickled
+    PRIMARY KEY (game_id, turn)
+);
+
+
+-- name: add_event!
+INSERT INTO game_event(game_id, turn, created_at, event)
+VALUES(:game_id, :turn, :created_at, :event)
+ON CONFLICT(game_id, turn) DO UPDATE SET
+    created_at = excluded.created_at,
+    event = excluded.event
+
+
+-- name: add_snapshot!
+INSERT INTO game_snapshot(game_id, turn, game)
+VALUES(:game_id, :turn, :game)
+ON CONFLICT(game_id, turn) DO UPDATE SET
+    game = excluded.game
+
+
+-- name: get_snapshot^
+SELECT turn, game
+FROM game_snapshot
+WHERE game_id = :game_id
+  AND turn <= :turn
+ORDER BY turn DESC
+LIMIT 1
+
+
+-- name: get_events
+SELECT turn, event
+FROM game_event
+WHERE game_id = :game_id
+  AND turn >= :from_turn
+  AND turn < :to_turn
+ORDER BY turn
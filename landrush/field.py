@@ -1,7 +1,10 @@
+import random
+
 import numpy as np
-from random import randint, choice
 from itertools import chain, product
 
+import landrush.profiling as profiling
+
 offsets = {
     "top": (0, -1),
     "right": (1, 0),
@@ -20,6 +23,13 @@ class Field:
     def __repr__(self):
         return "%d/%d" % self.index
 
+    def __getstate__(self):
+        # neighbors are restored by the board, pickling them recursively
+        # exceeds the recursion limit on large boards
+        state = self.__dict__.copy()
+        del state["neighbors"]
+        return state
+
     def to_json(self):
         return dict(land=self.land.id)
 
@@ -50,8 +60,8 @@ class Field:
 
 
 class Land:
-    def __init__(self, board, fields):
-        self.color = randint(1, 5)
+    def __init__(self, board, fields, rng=random):
+        self.color = rng.randint(1, 5)
         self.fields = []
         self.board = board
         self.neighbors = []
@@ -64,6 +74,13 @@ class Land:
     def __repr__(self):
         return repr(self.fields)
 
+    def __getstate__(self):
+        # restored by the board, see Field.__getstate__
+        state = self.__dict__.copy()
+        for key in ["fields", "neighbors", "neighbor_fields"]:
+            del state[key]
+        return state
+
     def to_json(self):
         d = dict(
             id=self.id,
@@ -106,7 +123,7 @@ class Land:
 
 
 class Board:
-    def __init__(self, size=(10, 10), joins=20):
+    def __init__(self, size=(10, 10), joins=20, rng=random):
         self.size = size
         self.all_indexes = set(product(range(self.size[0]), range(self.size[1])))
         self.fields = np.array(
@@ -114,25 +131,48 @@ class Board:
         )
 
         for field in self:
-            Land(self, [field])
+            Land(self, [field], rng)
 
         self.calc_neighbors()
 
+        # Choose from lists in a fixed order, so that the board only depends
+        # on the state of `rng`
+        lands = [field.land for field in self]
         for i in range(joins):
-            land = choice(list(self.lands))
-            joined_land = choice(list(land.neighbors))
-            land.add_land(joined_land)
-            self.calc_neighbors()
+            land = rng.choice(lands)
+            joined_land = rng.choice(sorted(land.neighbors, key=lambda l: l.id))
+            if joined_land is not land:
+                self.join_lands(land, joined_land)
+                lands.remove(joined_land)
 
     def __iter__(self):
         return chain(*self.fields)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["all_indexes"]
+        del state["lands"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if "lands" in state:
+            # pickled before neighbors were left out
+            return
+        self.all_indexes = set(product(range(self.size[0]), range(self.size[1])))
+        for field in self:
+            field.land.fields = []
+        for field in self:
+            field.land.fields.append(field)
+        self.calc_neighbors()
+
     def to_json(self):
         return dict(
             fields=self.fields,
             lands=self.lands,
         )
 
+    @profiling.profiled("calc_neighbors")
     def calc_neighbors(self):
         # fields
         for index in self.all_indexes:
@@ -155,6 +195,20 @@ class Board:
             land.neighbors = set(f.land for f in land.neighbor_fields)
             assert land.neighbors
 
+    def join_lands(self, land, joined_land):
+        """Merge `joined_land` into `land`, only updating the affected neighbors"""
+        if joined_land is land:
+            return
+        land.add_land(joined_land)
+        land.neighbor_fields = set(
+            chain.from_iterable(f.neighbors for f in land.fields)
+        )
+        land.neighbors = set(f.land for f in land.neighbor_fields)
+        for n in land.neighbors:
+            if joined_land in n.neighbors:
+                n.neighbors.remove(joined_land)
+                n.neighbors.add(land)
+
     @property
     def rows(self):
         return self.fields.transpose()
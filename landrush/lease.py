@@ -0,0 +1,88 @@
+"""Leases which make sure that only one request resolves an auction
+
+When the deadline of a turn has passed, all requests showing the game would
+resolve the auction. Instead, the request which gets the lease resolves it
+and releases the lease in the same commit that saves the game. The others
+wait up to WAIT_TIME for that and otherwise show the game as it was before.
+If resolving fails, the lease is released right away with `abandon`, so
+that the others don't wait for it.
+
+Leases are stored in the game's database, so this works across uWSGI
+workers. If the holder dies, its lease expires after LEASE_TIME seconds.
+"""
+
+import time
+import random
+from collections import Counter
+
+from landrush import storage
+from landrush.writer import write, execute
+
+LEASE_TIME = 30
+WAIT_TIME = 2
+POLL_INTERVAL = 0.05
+
+queries = storage.load_queries("lease.sql")
+_counts: Counter = Counter()
+_wait_time = 0.0
+
+
+def acquire(game_id, turn):
+    """Return a holder id if we may resolve `turn`, None otherwise"""
+    holder = random.getrandbits(62)
+    now = time.time()
+    if (
+        execute(
+            queries.acquire_lease,
+            game_id=game_id,
+            turn=turn,
+            holder=holder,
+            expires_at=now + LEASE_TIME,
+            now=now,
+        )
+        == holder
+    ):
+        _counts["acquired"] += 1
+        return holder
+    _counts["contended"] += 1
+    return None
+
+
+def release(game_id, holder):
+    """Queue the release, to be committed together with the resolved game"""
+    write(queries.release_lease, game_id=game_id, holder=holder)
+
+
+def abandon(game_id, holder):
+    """Release the lease now, when the game could not be resolved"""
+    _counts["abandoned"] += 1
+    execute(queries.release_lease, game_id=game_id, holder=holder)
+
+
+def wait(game_id):
+    """Wait until nobody holds the lease, return False on timeout"""
+    global _wait_time
+    start_time = time.monotonic()
+    db = storage.game_db(game_id)
+    try:
+        while time.monotonic() - start_time < WAIT_TIME:
+            time.sleep(POLL_INTERVAL)
+            if queries.get_active_lease(db, game_id=game_id, now=time.time()) is None:
+                _counts["waited"] += 1
+                return True
+        _counts["timed_out"] += 1
+        return False
+    finally:
+        _wait_time += time.monotonic() - start_time
+
+
+def metrics():
+    waits = _counts["waited"] + _counts["timed_out"]
+    return dict(
+        acquired=_counts["acquired"],
+        contended=_counts["contended"],
+        waited=_counts["waited"],
+        timed_out=_counts["timed_out"],
+        abandoned=_counts["abandoned"],
+        average_wait_time=_wait_time / waits if waits else 0,
+    )
@@ -0,0 +1,38 @@
+-- name: create-schema#
+-- The request currently resolving the auction of a game, see lease.py
+CREATE TABLE IF NOT EXISTS auction_lease(
+    game_id INT NOT NULL PRIMARY KEY,
+    turn INT NOT NULL,
+    holder BIGINT NOT NULL,  -- random
+    expires_at FLOAT NOT NULL
+);
+
+
+-- name: acquire_lease$
+-- Only succeeds while the game is still at `turn` and nobody else holds an
+-- unexpired lease for it. Returns the holder if successful.
+INSERT INTO auction_lease(game_id, turn, holder, expires_at)
+SELECT game_id, turn, :holder, :expires_at
+FROM game
+WHERE game_id = :game_id
+  AND turn = :turn
+ON CONFLICT(game_id) DO UPDATE SET
+    turn = excluded.turn,
+    holder = excluded.holder,
+    expires_at = excluded.expires_at
+WHERE auction_lease.turn < excluded.turn
+   OR auction_lease.expires_at < :now
+RETURNING holder
+
+
+-- name: release_lease!
+DELETE FROM auction_lease
+WHERE game_id = :game_id
+  AND holder = :holder
+
+
+-- name: get_active_lease$
+SELECT holder
+FROM auction_lease
+WHERE game_id = :game_id
+  AND expires_at >= :now
@@ -24,6 +24,8 @@ def send_mails(mails):
         msg["To"] = player.email
         msg.set_content(body)
         messages.append(msg)
+    if not messages:
+        return
 
     with smtplib.SMTP("smtp.sendgrid.net", port=587) as smtp:
         try:
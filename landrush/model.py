@@ -1,18 +1,27 @@
 import math
 import os
-from random import shuffle, randint
+import time
+import random
 from itertools import chain
 from datetime import datetime, timedelta
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, fields
 from typing import Optional
 import pickle
 
-from flask import g, url_for
+from flask import g, url_for, current_app as app
 
 import landrush.ai as ai
+import landrush.auction as auction
+import landrush.boardpool as boardpool
+import landrush.events as events
 import landrush.mail as mail
+import landrush.profiling as profiling
+import landrush.stats as stats
 from landrush.field import Board
 
+# Log a warning if resolving a turn takes longer than this (in seconds)
+RESOLVE_TIME_BUDGET = 1.0
+
 
 @dataclass
 class Game:
@@ -37,13 +46,14 @@ class Game:
     allowed_missed_deadlines: int = 2
     public: bool = False
 
+    @profiling.profiled("unpickle")
     def __post_init__(self):
         # convert values from db to python
-        if isinstance(self.state, bytes):
+        if isinstance(self.state, (bytes, memoryview)):
             self.state = pickle.loads(self.state)  # type: ignore
         for key in ["created_at", "finished_at", "next_auction_time"]:
             value = getattr(self, key)
-            if isinstance(value, float):
+            if isinstance(value, (int, float)):
                 setattr(self, key, datetime.utcfromtimestamp(value))
 
     @classmethod
@@ -56,21 +66,35 @@ class Game:
         max_time=24,
         public=False,
         auction_order="random",
+        board_size="normal",
+        rng=None,
     ):
-        auction_size = 3 + (players - 2) // 3
-        x_size = 9
-        y_size = int(round(auction_size * 2.3))
-        board = Board(size=(x_size, y_size), joins=int(x_size * y_size * 0.4))
+        """Create a game, `rng` makes it reproducible"""
+        if board_size == "large":
+            # about 60 fields and one land per auction for each player
+            auction_size = players
+            x_size = y_size = int(round(math.sqrt(players * 60)))
+        else:
+            auction_size = 3 + (players - 2) // 3
+            x_size = 9
+            y_size = int(round(auction_size * 2.3))
+        joins = int(x_size * y_size * 0.4)
+        if rng is None:
+            board = boardpool.get_board((x_size, y_size), joins=joins)
+            rng = random
+        else:
+            board = Board((x_size, y_size), joins, rng)
         new_money = 25 * players
         final_payout = new_money * 5
         self = cls(
-            game_id=g.next_game_id,
+            game_id=g.storage.next_game_id(g.db),
             state=dict(
                 board=board,
                 auction=[],
                 upcoming_auction=[],
                 last_auction=[],
                 players=[],
+                seed=rng.getrandbits(32),
             ),
             number_of_players=players,
             max_time=max_time,
@@ -87,9 +111,22 @@ class Game:
         )
         self.state["auction"] = self.make_auction()
         self.state["upcoming_auction"] = self.make_auction()
-        g.next_game_id += 1
         return self
 
+    def __getstate__(self):
+        # the random generator is recreated from the seed when needed
+        state = self.__dict__.copy()
+        state.pop("_rng", None)
+        return state
+
+    @property
+    def rng(self):
+        """Random numbers for the current turn, reproducible from the seed"""
+        if getattr(self, "_rng", (None, None))[0] != self.turn:
+            seed = "%s/%d" % (self.state.get("seed", self.game_id), self.turn)
+            self._rng = (self.turn, random.Random(seed))
+        return self._rng[1]
+
     @property
     def board(self):
         return self.state["board"]
@@ -133,58 +170,45 @@ class Game:
         return (self.remaining_turns - 1) * self.new_money + self.final_payout
 
     def resolve_auction(self):
+        start_time = time.perf_counter()
+        event: dict = dict(missed_deadline=[], became_ai=[])
+
         # place bids for ai and missing players
         for p in self.players:
             if p.bids is None and not p.ai and not p.quit:
-                p.missed_deadlines += 1
-                times_left = self.allowed_missed_deadlines - p.missed_deadlines
-                if times_left == 0:
-                    p.ai = True
-                    message = """ You have missed the auction deadline too
-                               often.  We don't need you, anymore. Be on time
-                               during your next game! """
-                else:
-                    if times_left == 1:
-                        more_text = "one more time"
-                    else:
-                        more_text = "%d more times" % times_left
-                    message = (
-                        """ You have missed the auction deadline, so
-                               your nephew placed some bids for you. If you do
-                               this %s, he will go on without you."""
-                        % more_text
-                    )
-                p.messages.append([message, "danger"])
-            if p.ai or p.bids is None:
-                p.bids = ai.calculate_bids(self, p)
+                p.miss_deadline(self.allowed_missed_deadlines)
+                event["missed_deadline"].append(p.id)
+                if p.ai:
+                    event["became_ai"].append(p.id)
+        ai_players = [p for p in self.players if p.ai or p.bids is None]
+        ai_bids = ai.calculate_bids_for_players(self, ai_players)
+        for p, bids in zip(ai_players, ai_bids):
+            p.bids = bids
 
         # resolve auction
         self.state["last_auction"] = []
-        for i in range(len(self.auction)):
-            # reduce bids to available money
-            for p in self.players:
-                p.bids[i] = min(p.bids[i], p.money)
-
-            # detect winner
-            bidding_players = sorted(
-                self.players, key=lambda p: (-p.bids[i], randint(0, 1000))
+        if self.players and self.auction:
+            bids, winners, prices = auction.resolve(
+                [p.bids for p in self.players],
+                [p.money for p in self.players],
+                self.auction_type,
+                seed=(self.state.get("seed", self.game_id), self.turn),
             )
-            if not bidding_players:
-                continue
-            winner = bidding_players[0]
-
-            # transfer land to winner
-            land = self.auction[i]
-            if self.auction_type == "1st_price":
-                price = winner.bids[i]
-            elif self.auction_type == "2nd_price":
-                price = bidding_players[1].bids[i]
-            else:
-                raise Exception("Unknown auction type")
-            winner.money -= price
-            land.owner = winner
-            land.price = price
-            self.state["last_auction"].append(land)
+            for p, player_bids in zip(self.players, bids.tolist()):
+                p.bids = player_bids
+
+            # transfer lands to winners
+            for land, w, price in zip(self.auction, winners, prices.tolist()):
+                winner = self.players[w]
+                winner.money -= price
+                land.owner = winner
+                land.price = price
+                self.state["last_auction"].append(land)
+
+        event["sales"] = [
+            (l.id, l.owner.id, l.price) for l in self.state["last_auction"]
+        ]
+        event["bids"] = [(p.id, p.bids) for p in self.players]
 
         # clear bids
         for p in self.players:
@@ -195,6 +219,8 @@ class Game:
         self.state["auction"] = self.upcoming_auction
         self.state["upcoming_auction"] = self.make_auction()
         self.next_auction_time = datetime.utcnow() + timedelta(hours=self.max_time)
+        event["upcoming_auction"] = [l.id for l in self.upcoming_auction]
+        event["next_auction_time"] = self.next_auction_time.timestamp()
 
         # update connected_lands
         for p in self.players:
@@ -202,13 +228,28 @@ class Game:
 
         self.distribute_money()
         self.turn += 1
+        event["payouts"] = [(p.id, p.payout) for p in self.players]
+        events.turn_resolved(self, event)
+        if self.status == "finished":
+            # set by `payouts` when the last land has been sold
+            stats.game_finished(self)
+
+        duration = time.perf_counter() - start_time
+        if duration > RESOLVE_TIME_BUDGET:
+            app.logger.warning(
+                "Resolving turn %d of game %d took %.2fs",
+                self.turn,
+                self.game_id,
+                duration,
+            )
         mail.turn_finished(self)
 
     def make_auction(self):
-        free_lands = list(
-            {l for l in self.board.lands if not l.owner} - set(self.auction)
+        free_lands = sorted(
+            {l for l in self.board.lands if not l.owner} - set(self.auction),
+            key=lambda l: l.id,
         )
-        shuffle(free_lands)
+        self.rng.shuffle(free_lands)
         sort_order = {
             "random": lambda l: 0,
             "go_west": lambda l: -max(f.index[0] for f in l.fields),
@@ -254,7 +295,7 @@ class Game:
                 -len(p.lands),
                 -p.last_bid_sum,
                 p.money,
-                randint(0, 1000),
+                self.rng.randint(0, 1000),
             )
         )
         for payout, player in zip(self.payouts, self.players):
@@ -263,17 +304,21 @@ class Game:
             if player.money <= 0:
                 player.quit = True
 
-    def start(self):
+    def start(self, rng=random):
         self.status = "in_progress"
         self.next_auction_time = datetime.utcnow() + timedelta(hours=self.max_time)
         # add AI players
         for i in range(self.number_of_players - len(self.players)):
-            player = Player(ai.player_name(), self, ai=True)
+            player = Player(ai.player_name(rng), self, ai=True, rng=rng)
             self.players.append(player)
-
-    def as_db_dict(self):
-        d = asdict(self)
-        d["state"] = pickle.dumps(self.state)
+        events.save_snapshot(self)
+
+    def as_db_dict(self, with_state=True):
+        # shallow copy, the state is pickled anyway
+        d = {f.name: getattr(self, f.name) for f in fields(self) if f.name != "state"}
+        if with_state:
+            # `events.catch_up` replays the turns after saved_turn
+            d["state"] = pickle.dumps(dict(self.state, saved_turn=self.turn))
         for key in ["created_at", "finished_at", "next_auction_time"]:
             if d[key] is not None:
                 d[key] = d[key].timestamp()
@@ -286,12 +331,12 @@ def flatten(listOfLists):
 
 
 class Player(object):
-    def __init__(self, name, game, ai=False):
+    def __init__(self, name, game, ai=False, rng=random):
         self.name = name
         self.money = game.start_money
         self.bids = None
-        self.id = randint(1, 10000000)
-        self.secret = randint(1, 1000000000)
+        self.id = rng.randint(1, 10000000)
+        self.secret = rng.randint(1, 1000000000)
         self.player_number = len(game.players) + 1
         self.connected_lands = 0
         self.game_id = game.game_id
@@ -316,6 +361,7 @@ class Player(object):
             del data["secret"]
         return data
 
+    @profiling.profiled("islands")
     def islands(self):
         """Islands are a set of connected lands"""
         last_islands = None
@@ -332,6 +378,24 @@ class Player(object):
             }
         return islands
 
+    def miss_deadline(self, allowed_missed_deadlines):
+        self.missed_deadlines += 1
+        times_left = allowed_missed_deadlines - self.missed_deadlines
+        if times_left == 0:
+            self.ai = True
+            message = """ You have missed the auction deadline too
+                       often.  We don't need you, anymore. Be on time
+                       during your next game! """
+        else:
+            if times_left == 1:
+                more_text = "one more time"
+            else:
+                more_text = "%d more times" % times_left
+            message = """ You have missed the auction deadline, so
+                       your nephew placed some bids for you. If you do
+                       this %s, he will go on without you.""" % more_text
+        self.messages.append([message, "danger"])
+
     def update_connected_lands(self):
         if not self.lands:
             return
@@ -0,0 +1,264 @@
+"""Stronger AI which simulates the rest of the game for candidate bids
+
+The game is copied into a compact `State` made of plain lists, which can be
+cloned cheaply for each rollout. Rollouts run in a process pool until a
+wall-clock deadline; if the pool does not answer in time, the heuristic bids
+are used.
+
+The pool uses the forkserver start method, because forking the multi-threaded
+web server could copy locks held by other threads into the workers.
+"""
+
+import os
+import math
+import time
+import random
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from typing import List, Optional
+
+# Candidate bids are the heuristic bids scaled by these factors
+BID_FACTORS = [0.5, 0.75, 1, 1.25, 1.5, 2]
+# Opponent bids are the heuristic bids with log-normal noise of this sigma
+BID_NOISE = 0.3
+# Extra time granted to the pool to return its results
+GRACE_TIME = 0.2
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass
+class State:
+    neighbors: List[frozenset]  # land index -> neighbor land indexes
+    owners: List[int]  # land index -> player index, -1 if free
+    money: List[float]  # player index -> money
+    auction: List[int]
+    upcoming_auction: List[int]
+    auction_size: int
+    auction_type: str
+    start_money: int
+    new_money: int
+    final_payout: int
+    payout_exponent: float
+
+    @classmethod
+    def from_game(cls, game):
+        lands = list(game.board.lands)
+        land_index = {land: i for i, land in enumerate(lands)}
+        player_index = {p.id: i for i, p in enumerate(game.players)}
+        return cls(
+            neighbors=[
+                frozenset(land_index[n] for n in land.neighbors if n is not land)
+                for land in lands
+            ],
+            owners=[
+                player_index[land.owner.id] if land.owner else -1 for land in lands
+            ],
+            money=[p.money for p in game.players],
+            auction=[land_index[land] for land in game.auction],
+            upcoming_auction=[land_index[land] for land in game.upcoming_auction],
+            auction_size=game.auction_size,
+            auction_type=game.auction_type,
+            start_money=game.start_money,
+            new_money=game.new_money,
+            final_payout=game.final_payout,
+            payout_exponent=game.payout_exponent,
+        )
+
+    def copy(self):
+        """Clone the mutable parts, the board layout is shared"""
+        return State(
+            **dict(
+                self.__dict__,
+                owners=list(self.owners),
+                money=list(self.money),
+                auction=list(self.auction),
+                upcoming_auction=list(self.upcoming_auction),
+            )
+        )
+
+    def islands(self, player):
+        owned = {i for i, owner in enumerate(self.owners) if owner == player}
+        islands = []
+        while owned:
+            island = {owned.pop()}
+            todo = list(island)
+            while todo:
+                for n in self.neighbors[todo.pop()] & owned:
+                    owned.remove(n)
+                    island.add(n)
+                    todo.append(n)
+            islands.append(island)
+        return islands
+
+    def heuristic_bids(self, player, rng):
+        """Same rules as `ai.calc_bid_for_land`, with noise"""
+        free_lands = self.owners.count(-1)
+        remaining_turns = math.ceil(free_lands / self.auction_size)
+        remaining_payout = (
+            (remaining_turns - 1) * self.new_money + self.final_payout
+            if remaining_turns
+            else 0
+        )
+        base_price = remaining_payout / len(self.owners)
+        islands = self.islands(player)
+        largest: set = set()
+        if islands:
+            max_island_size = max(len(i) for i in islands)
+            largest = set().union(*(i for i in islands if len(i) == max_island_size))
+        spending_factor = self.money[player] / self.start_money
+
+        bids = []
+        for land in self.auction:
+            if islands:
+                base_factor = 0.5 if self.neighbors[land] & largest else 0.1
+            else:
+                base_factor = 0.5
+            # the land itself counts as free neighbor in the heuristic AI
+            neighbors_factor = 0.3 + sum(
+                0.15 if self.owners[n] == player else 0.3 if self.owners[n] < 0 else 0
+                for n in self.neighbors[land]
+            )
+            bids.append(
+                base_price
+                * (base_factor + neighbors_factor)
+                * spending_factor
+                * rng.lognormvariate(0, BID_NOISE)
+            )
+        return bids
+
+    def play_turn(self, bids, rng):
+        """Resolve the current auction like `Game.resolve_auction`"""
+        bid_sums = [0.0] * len(self.money)
+        for i, land in enumerate(self.auction):
+            for p, money in enumerate(self.money):
+                bids[p][i] = min(bids[p][i], money)
+                bid_sums[p] += bids[p][i]
+            ranking = sorted(
+                range(len(self.money)), key=lambda p: (-bids[p][i], rng.random())
+            )
+            winner = ranking[0]
+            if self.auction_type == "1st_price":
+                price = bids[winner][i]
+            else:
+                price = bids[ranking[1]][i]
+            self.money[winner] -= price
+            self.owners[land] = winner
+
+        self.auction = self.upcoming_auction
+        free_lands = [
+            i
+            for i, owner in enumerate(self.owners)
+            if owner < 0 and i not in self.auction
+        ]
+        self.upcoming_auction = rng.sample(
+            free_lands, min(self.auction_size, len(free_lands))
+        )
+
+        # distribute money
+        def rank(p):
+            islands = self.islands(p)
+            return (
+                -max((len(i) for i in islands), default=0),
+                -self.owners.count(p),
+                -bid_sums[p],
+                self.money[p],
+                rng.random(),
+            )
+
+        n = len(self.money)
+        payouts = [p**self.payout_exponent for p in reversed(range(n))]
+        payouts[-1] -= max((n - 2) / 2, 0)
+        total_payout = self.new_money if self.auction else self.final_payout
+        scaling = total_payout / sum(payouts)
+        for payout, p in zip(payouts, sorted(range(n), key=rank)):
+            self.money[p] += int(round(payout * scaling))
+
+    def rollout(self, player, first_bids, rng):
+        """Play until the end and return the share of opponents beaten"""
+        state = self.copy()
+        bids = [
+            list(first_bids) if p == player else state.heuristic_bids(p, rng)
+            for p in range(len(state.money))
+        ]
+        state.play_turn(bids, rng)
+        while state.auction:
+            bids = [state.heuristic_bids(p, rng) for p in range(len(state.money))]
+            state.play_turn(bids, rng)
+
+        beaten = sum(m < state.money[player] for m in state.money)
+        return beaten / (len(state.money) - 1)
+
+
+def _run_rollouts(state, candidates, deadline, seed):
+    """Evaluate candidate bids of several players until the deadline
+
+    `candidates` maps player index to a list of bid lists. Returns the sum of
+    scores and the number of rollouts for each of them.
+    """
+    rng = random.Random(seed)
+    scores = {p: [0.0] * len(c) for p, c in candidates.items()}
+    counts = {p: [0] * len(c) for p, c in candidates.items()}
+    jobs = [(p, i) for p, c in candidates.items() for i in range(len(c))]
+    while time.time() < deadline:
+        for p, i in jobs:
+            scores[p][i] += state.rollout(p, candidates[p][i], rng)
+            counts[p][i] += 1
+            if time.time() >= deadline:
+                break
+    return scores, counts
+
+
+def processes():
+    return int(os.environ.get("LANDRUSH_AI_PROCESSES", os.cpu_count() or 1))
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            processes(), mp_context=multiprocessing.get_context("forkserver")
+        )
+    return _pool
+
+
+def calculate_bids(game, players, heuristic_bids, deadline):
+    """Improve the heuristic bids of `players` until `deadline`
+
+    `deadline` is a `time.time()` value. The results may arrive up to
+    GRACE_TIME seconds later.
+    """
+    global _pool
+    state = State.from_game(game)
+    player_index = {p.id: i for i, p in enumerate(game.players)}
+    candidates = {
+        player_index[p.id]: [[b * f for b in bids] for f in BID_FACTORS]
+        for p, bids in zip(players, heuristic_bids)
+    }
+
+    try:
+        futures = [
+            get_pool().submit(
+                _run_rollouts, state, candidates, deadline, random.getrandbits(32)
+            )
+            for i in range(processes())
+        ]
+        done, not_done = wait(futures, timeout=deadline - time.time() + GRACE_TIME)
+        results = [f.result() for f in done]
+    except Exception:
+        # e.g. a broken pool, start a new one next time
+        _pool = None
+        return heuristic_bids
+
+    best_bids = []
+    for p, bids in zip(players, heuristic_bids):
+        p_idx = player_index[p.id]
+        scores = [sum(r[0][p_idx][i] for r in results) for i in range(len(BID_FACTORS))]
+        counts = [sum(r[1][p_idx][i] for r in results) for i in range(len(BID_FACTORS))]
+        if not all(counts):
+            best_bids.append(bids)
+            continue
+        best = max(range(len(BID_FACTORS)), key=lambda i: scores[i] / counts[i])
+        best_bids.append([round(b) for b in candidates[p_idx][best]])
+    return best_bids
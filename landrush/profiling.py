@@ -0,0 +1,168 @@
+"""Optional memory profiling of the hot paths in a game's lifecycle
+
+Set LANDRUSH_MEMORY_PROFILE=1 to trace allocations with tracemalloc. The
+profiled stages (see `stage` and `profiled`) then record
+
+- net_size: memory still allocated when the stage returns
+- peak: the highest memory use during the stage, above its start
+
+for every call. Taking snapshots is slow, so only the first call of each
+stage in a request is compared with a snapshot from before the call, which
+gives
+
+- net_blocks: number of memory blocks still allocated after sampled calls
+- top_sites: the source lines with the largest net allocations
+
+The totals since the start of the process are shown at /admin/memory,
+together with the stages of the last requests and their URL rules. If
+LANDRUSH_MEMORY_PROFILE_DIR is set, the stages of each request are also
+appended to memory-<pid>.jsonl in that directory.
+
+Tracing makes everything a lot slower, and concurrent requests are mixed up
+in the numbers, so only use this with a single worker thread.
+"""
+
+import os
+import json
+import threading
+import functools
+import tracemalloc
+from collections import Counter, deque
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+ENABLED = os.environ.get("LANDRUSH_MEMORY_PROFILE", "") not in ("", "0")
+PROFILE_DIR = os.environ.get("LANDRUSH_MEMORY_PROFILE_DIR")
+TOP_SITES = 10
+RECENT_REQUESTS = 50
+
+# don't count the memory used for profiling
+_filters = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+]
+_local = threading.local()
+_lock = threading.Lock()
+_stages: dict = {}  # stage name -> totals
+_recent: deque = deque(maxlen=RECENT_REQUESTS)
+
+if ENABLED:
+    tracemalloc.start()
+
+
+@contextmanager
+def stage(name):
+    """Record the allocations of the enclosed code as stage `name`"""
+    if not ENABLED:
+        yield
+        return
+
+    stack = _local.__dict__.setdefault("stack", [])
+    if has_request_context():
+        sampled_stages = g.setdefault("memory_sampled", set())
+    else:
+        sampled_stages = _local.__dict__.setdefault("sampled", set())
+    before = None
+    if name not in sampled_stages:
+        sampled_stages.add(name)
+        before = tracemalloc.take_snapshot().filter_traces(_filters)
+
+    start, peak = tracemalloc.get_traced_memory()
+    if stack:
+        # the enclosing stage's peak is lost by resetting it
+        stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+    tracemalloc.reset_peak()
+    frame = dict(peak=start)
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(frame["peak"], peak)
+        if stack:
+            stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+        stats = None
+        if before is not None:
+            after = tracemalloc.take_snapshot().filter_traces(_filters)
+            stats = after.compare_to(before, "lineno")
+        _record(name, current - start, peak - start, stats)
+
+
+def profiled(name):
+    """Decorator which records each call as stage `name`"""
+
+    def decorator(f):
+        if not ENABLED:
+            return f
+
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return f(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _add(totals, net_size, peak, stats):
+    totals["calls"] += 1
+    totals["net_size"] += net_size
+    totals["peak"] = max(totals["peak"], peak)
+    if stats is None:
+        return
+    totals["sampled_calls"] += 1
+    totals["net_blocks"] += sum(s.count_diff for s in stats)
+    for s in stats:
+        if s.size_diff > 0:
+            totals["sites"][str(s.traceback)] += s.size_diff
+
+
+def _new_totals():
+    return dict(
+        calls=0, net_size=0, peak=0, sampled_calls=0, net_blocks=0, sites=Counter()
+    )
+
+
+def _record(name, net_size, peak, stats):
+    with _lock:
+        _add(_stages.setdefault(name, _new_totals()), net_size, peak, stats)
+    if has_request_context():
+        request_stages = g.setdefault("memory_stages", {})
+        _add(request_stages.setdefault(name, _new_totals()), net_size, peak, stats)
+
+
+def _summary(stages):
+    return {
+        name: dict(
+            {k: v for k, v in totals.items() if k != "sites"},
+            top_sites=totals["sites"].most_common(TOP_SITES),
+        )
+        for name, totals in stages.items()
+    }
+
+
+def request_finished(rule):
+    """Keep the stages of the current request, call once per request"""
+    stages = g.pop("memory_stages", None)
+    if not stages:
+        return
+    entry = dict(rule=rule, stages=_summary(stages))
+    _recent.append(entry)
+    if PROFILE_DIR:
+        filename = os.path.join(PROFILE_DIR, "memory-%d.jsonl" % os.getpid())
+        with _lock, open(filename, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+
+def report():
+    current, peak = tracemalloc.get_traced_memory()
+    with _lock:
+        stages = _summary(_stages)
+    return dict(
+        traced_memory=dict(current=current, peak=peak),
+        stages=stages,
+        recent_requests=list(_recent),
+    )
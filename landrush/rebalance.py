@@ -0,0 +1,102 @@
+"""Move the games into a different number of SQLite shards
+
+Run with `python -m landrush.rebalance OLD_SHARDS NEW_SHARDS` while the app
+is stopped, then restart it with LANDRUSH_SHARDS=NEW_SHARDS. Use 1 as
+OLD_SHARDS to split up a database which is not sharded yet, also one from
+an older version without some of the tables. The old files are left
+untouched and can be deleted afterwards. The new files only appear once all
+of them are complete.
+"""
+
+import os
+import sys
+
+from landrush import DB_PATH, create_schema, storage
+
+# Tables with a game_id column, split by game
+GAME_TABLES = [
+    "game",
+    "game_player",
+    "bid",
+    "notification_settings",
+    "game_event",
+    "game_snapshot",
+]
+# Tables kept in the main shard
+MAIN_TABLES = ["player_stats", "group_stats", "group_games", "board_pool"]
+
+
+def rebalance(path, old_shards, new_shards):
+    sources = storage.shard_paths(path, old_shards)
+    targets = storage.shard_paths(path, new_shards)
+    for source in sources:
+        if not os.path.exists(source):
+            raise SystemExit("%s does not exist" % source)
+    for target in targets:
+        if os.path.exists(target):
+            raise SystemExit("%s already exists" % target)
+
+    # only renamed when all shards are complete
+    temporary_paths = [target + ".tmp" for target in targets]
+    try:
+        for i, temporary_path in enumerate(temporary_paths):
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+            games = copy_games(temporary_path, sources, new_shards, i)
+            print("%s: %d games" % (os.path.basename(targets[i]), games))
+    except BaseException:
+        for temporary_path in temporary_paths:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+        raise
+    for temporary_path, target in zip(temporary_paths, targets):
+        os.rename(temporary_path, target)
+
+
+def copy_games(target, sources, new_shards, i):
+    """Create shard `i` of `new_shards` at `target`, return the number of games"""
+    shard = storage.SQLiteStorage(target)
+    db = shard.connect()
+    create_schema(shard, db)
+    for source in sources:
+        db.execute("ATTACH DATABASE ? AS source", (source,))
+        # databases from older versions don't have all tables
+        source_tables = {
+            row[0]
+            for row in db.execute(
+                "SELECT name FROM source.sqlite_master WHERE type = 'table'"
+            )
+        }
+        with db:
+            for table in GAME_TABLES:
+                if table not in source_tables:
+                    continue
+                db.execute(
+                    "INSERT INTO %s SELECT * FROM source.%s "
+                    "WHERE game_id %% ? = ?" % (table, table),
+                    (new_shards, i),
+                )
+            if i == 0:
+                for table in MAIN_TABLES:
+                    if table not in source_tables:
+                        continue
+                    db.execute(
+                        "INSERT INTO %s SELECT * FROM source.%s" % (table, table)
+                    )
+        db.execute("DETACH DATABASE source")
+    games = db.execute("SELECT count(*) FROM game").fetchone()[0]
+    shard.release(db)
+    return games
+
+
+def main():
+    if len(sys.argv) != 3:
+        raise SystemExit(__doc__)
+    old_shards, new_shards = map(int, sys.argv[1:])
+    if old_shards == new_shards:
+        raise SystemExit("Nothing to do")
+    rebalance(DB_PATH, old_shards, new_shards)
+
+
+if __name__ == "__main__":
+    main()
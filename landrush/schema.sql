@@ -1,7 +1,7 @@
 -- name: create-schema#
-CREATE TABLE game(
+CREATE TABLE IF NOT EXISTS game(
     game_id INT NOT NULL PRIMARY KEY,
-    state PICKLE NOT NULL,
+    state BYTEA NOT NULL,  -- pickled
     number_of_players INT NOT NULL,
     max_time FLOAT NOT NULL,
     auction_size INT NOT NULL,
@@ -22,9 +22,34 @@ CREATE TABLE game(
     public BOOL NOT NULL
 );
 
+-- Pending bids are kept outside of the game state, so that placing a bid
+-- does not have to rewrite the whole game.
+CREATE TABLE IF NOT EXISTS bid(
+    game_id INT NOT NULL,
+    player_secret INT NOT NULL,
+    turn INT NOT NULL,
+    bids TEXT NOT NULL,  -- JSON list, one bid per auctioned land
+    PRIMARY KEY (game_id, player_secret, turn)
+);
+
+-- Allows checking the secret in a request without loading the game
+CREATE TABLE IF NOT EXISTS game_player(
+    game_id INT NOT NULL,
+    player_secret INT NOT NULL,
+    PRIMARY KEY (game_id, player_secret)
+);
+
+CREATE TABLE IF NOT EXISTS notification_settings(
+    game_id INT NOT NULL,
+    player_secret INT NOT NULL,
+    email TEXT NOT NULL,
+    notify TEXT NOT NULL,
+    PRIMARY KEY (game_id, player_secret)
+);
+
 
 -- name: save_game!
-INSERT OR REPLACE INTO game(
+INSERT INTO game(
     game_id, state, number_of_players, max_time, auction_size, start_money,
     new_money, final_payout, auction_type, name, version, created_at,
     finished_at, status, turn, auction_order, next_auction_time,
@@ -36,6 +61,37 @@ VALUES(
     :finished_at, :status, :turn, :auction_order, :next_auction_time,
     :payout_exponent, :allowed_missed_deadlines, :public
 )
+ON CONFLICT(game_id) DO UPDATE SET
+    state = excluded.state,
+    number_of_players = excluded.number_of_players,
+    max_time = excluded.max_time,
+    auction_size = excluded.auction_size,
+    start_money = excluded.start_money,
+    new_money = excluded.new_money,
+    final_payout = excluded.final_payout,
+    auction_type = excluded.auction_type,
+    name = excluded.name,
+    version = excluded.version,
+    created_at = excluded.created_at,
+    finished_at = excluded.finished_at,
+    status = excluded.status,
+    turn = excluded.turn,
+    auction_order = excluded.auction_order,
+    next_auction_time = excluded.next_auction_time,
+    payout_exponent = excluded.payout_exponent,
+    allowed_missed_deadlines = excluded.allowed_missed_deadlines,
+    public = excluded.public
+
+
+-- name: save_game_progress!
+-- Everything which resolving a turn changes, except for the pickled state
+UPDATE game
+SET version = :version,
+    finished_at = :finished_at,
+    status = :status,
+    turn = :turn,
+    next_auction_time = :next_auction_time
+WHERE game_id = :game_id
 
 
 -- name: get_game^
@@ -51,7 +107,7 @@ SELECT *
 FROM game
 WHERE public
   AND status = 'new'
-  AND created_at BETWEEN strftime('%s', 'now') - 30 * 24 * 60 * 60 AND strftime('%s', 'now')  -- last 30 days
+  AND created_at BETWEEN :now - 30 * 24 * 60 * 60 AND :now  -- last 30 days
 
 
 -- name: get_games_by_status
@@ -60,5 +116,69 @@ SELECT *
 FROM game
 WHERE public
   AND status = :status
-ORDER BY finished_at DESC, created_at DESC
+ORDER BY finished_at DESC NULLS LAST, created_at DESC
 LIMIT :limit
+
+
+-- name: get_game_version^
+-- Everything the spectator view of a game depends on
+SELECT version, turn, status, next_auction_time, (
+        SELECT count(*)
+        FROM bid
+        WHERE bid.game_id = game.game_id
+          AND bid.turn = game.turn
+    ) AS bids
+FROM game
+WHERE game_id = :game_id
+
+
+-- name: get_turn$
+SELECT turn
+FROM game
+WHERE game_id = :game_id
+
+
+-- name: add_player!
+INSERT INTO game_player(game_id, player_secret)
+VALUES(:game_id, :player_secret)
+ON CONFLICT(game_id, player_secret) DO NOTHING
+
+
+-- name: get_player_secrets
+SELECT player_secret
+FROM game_player
+WHERE game_id = :game_id
+
+
+-- name: save_bids!
+INSERT INTO bid(game_id, player_secret, turn, bids)
+VALUES(:game_id, :player_secret, :turn, :bids)
+ON CONFLICT(game_id, player_secret, turn) DO UPDATE SET
+    bids = excluded.bids
+
+
+-- name: get_bids
+SELECT player_secret, bids
+FROM bid
+WHERE game_id = :game_id
+  AND turn = :turn
+
+
+-- name: delete_old_bids!
+DELETE FROM bid
+WHERE game_id = :game_id
+  AND turn < :turn
+
+
+-- name: save_notification_settings!
+INSERT INTO notification_settings(game_id, player_secret, email, notify)
+VALUES(:game_id, :player_secret, :email, :notify)
+ON CONFLICT(game_id, player_secret) DO UPDATE SET
+    email = excluded.email,
+    notify = excluded.notify
+
+
+-- name: get_notification_settings
+SELECT player_secret, email, notify
+FROM notification_settings
+WHERE game_id = :game_id
@@ -0,0 +1,66 @@
+from flask import g
+
+from landrush import storage
+from landrush.writer import write
+
+queries = storage.load_queries("stats.sql")
+
+# Names of players who did not choose one. They stand for many different
+# people, so they don't get player statistics.
+UNNAMED_PLAYERS = {"Anonymous", "Human"}
+
+
+def game_finished(game):
+    """Add the results of a finished game to the aggregated statistics
+
+    Called once when the game finishes. The changes are committed together
+    with the game.
+    """
+    max_money = max(p.money for p in game.players)
+    human_win = int(any(p.money == max_money and not p.ai for p in game.players))
+    for category, value in [("all", ""), ("auction_order", game.auction_order)]:
+        write(
+            queries.add_group_game,
+            category=category,
+            value=value,
+            human_win=human_win,
+        )
+    for p in game.players:
+        result = dict(ai=p.ai, win=int(p.money == max_money), money=p.money)
+        if p.name not in UNNAMED_PLAYERS:
+            write(queries.add_player_result, name=p.name, **result)
+        write(queries.add_group_result, category="all", value="", **result)
+        write(
+            queries.add_group_result,
+            category="auction_order",
+            value=game.auction_order,
+            **result,
+        )
+
+
+def leaderboard(limit=20):
+    # groups[category][value][ai] = results of all AI or human players
+    groups: dict = {}
+    # games[category][value] = number of games and games won by humans
+    games: dict = {}
+    for category, value, game_count, human_wins in queries.get_group_games(g.db):
+        games.setdefault(category, {})[value] = dict(
+            games=game_count, human_wins=human_wins
+        )
+    for category, value, ai, players, wins, average_money in queries.get_group_stats(
+        g.db
+    ):
+        groups.setdefault(category, {}).setdefault(value, {})[bool(ai)] = dict(
+            players=players, wins=wins, average_money=average_money
+        )
+
+    return dict(
+        # skip results from before unnamed players were left out
+        top_players=[
+            row
+            for row in queries.get_top_players(g.db, limit=limit + len(UNNAMED_PLAYERS))
+            if row[0] not in UNNAMED_PLAYERS
+        ][:limit],
+        groups=groups,
+        games=games,
+    )
@@ -0,0 +1,78 @@
+-- name: create-schema#
+-- Aggregates over all finished games, updated once when a game finishes
+CREATE TABLE IF NOT EXISTS player_stats(
+    name TEXT NOT NULL,
+    ai BOOL NOT NULL,
+    games INT NOT NULL,
+    wins INT NOT NULL,
+    total_money FLOAT NOT NULL,
+    PRIMARY KEY (name, ai)
+);
+CREATE INDEX IF NOT EXISTS player_stats_ranking ON player_stats(ai, wins DESC, games);
+
+-- Results grouped by game properties, e.g. category = 'auction_order' and
+-- value = 'go_west'. One row for AI and one for human players.
+CREATE TABLE IF NOT EXISTS group_stats(
+    category TEXT NOT NULL,
+    value TEXT NOT NULL,
+    ai BOOL NOT NULL,
+    players INT NOT NULL,
+    wins INT NOT NULL,
+    total_money FLOAT NOT NULL,
+    PRIMARY KEY (category, value, ai)
+);
+
+-- Number of games per group_stats category and value, and how many of them
+-- were won by a human. Counted once per game, also for ties.
+CREATE TABLE IF NOT EXISTS group_games(
+    category TEXT NOT NULL,
+    value TEXT NOT NULL,
+    games INT NOT NULL,
+    human_wins INT NOT NULL,
+    PRIMARY KEY (category, value)
+);
+
+
+-- name: add_player_result!
+INSERT INTO player_stats(name, ai, games, wins, total_money)
+VALUES(:name, :ai, 1, :win, :money)
+ON CONFLICT(name, ai) DO UPDATE SET
+    games = player_stats.games + 1,
+    wins = player_stats.wins + excluded.wins,
+    total_money = player_stats.total_money + excluded.total_money
+
+
+-- name: add_group_result!
+INSERT INTO group_stats(category, value, ai, players, wins, total_money)
+VALUES(:category, :value, :ai, 1, :win, :money)
+ON CONFLICT(category, value, ai) DO UPDATE SET
+    players = group_stats.players + 1,
+    wins = group_stats.wins + excluded.wins,
+    total_money = group_stats.total_money + excluded.total_money
+
+
+-- name: add_group_game!
+INSERT INTO group_games(category, value, games, human_wins)
+VALUES(:category, :value, 1, :human_win)
+ON CONFLICT(category, value) DO UPDATE SET
+    games = group_games.games + 1,
+    human_wins = group_games.human_wins + excluded.human_wins
+
+
+-- name: get_top_players
+SELECT name, games, wins, total_money / games AS average_money
+FROM player_stats
+WHERE NOT ai
+ORDER BY wins DESC, games
+LIMIT :limit
+
+
+-- name: get_group_stats
+SELECT category, value, ai, players, wins, total_money / players AS average_money
+FROM group_stats
+ORDER BY category, value, ai
+
+
+-- name: get_group_games
+SELECT category, value, games, human_wins
+FROM group_games
@@ -0,0 +1,259 @@
+"""Database backends
+
+SQLite is used by default. If LANDRUSH_DATABASE_URL is set to a
+postgresql:// URL, PostgreSQL is used instead, which requires psycopg2.
+
+With LANDRUSH_SHARDS set to N > 1, games are split by game_id across N
+SQLite files, so that writes to different games don't wait for the same
+file lock. Data not belonging to a single game (statistics, board pool) is
+kept in the first shard. Use landrush/rebalance.py to move existing games
+to a different number of shards.
+
+The queries in the *.sql files work with both databases. Everything else
+that differs between them is implemented by the backend classes below.
+To check a backend, run landrush/check_storage.py against an empty database.
+"""
+
+import os
+import sqlite3
+import threading
+
+import aiosql  # type: ignore
+from flask import g
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+DATABASE_URL = os.environ.get("LANDRUSH_DATABASE_URL", "")
+if DATABASE_URL.startswith(("postgres://", "postgresql://")):
+    DRIVER = "psycopg2"
+else:
+    DRIVER = "sqlite3"
+SHARDS = int(os.environ.get("LANDRUSH_SHARDS", 1))
+# Seconds to wait for a free PostgreSQL connection
+CONNECT_TIMEOUT = 30
+# Any number, as long as no other advisory lock in the database uses it
+SCHEMA_LOCK_ID = 7264
+# Games share this many locks in SQLiteStorage.lock_game
+GAME_LOCKS = 64
+
+
+def load_queries(filename, **kwargs):
+    return aiosql.from_path(os.path.join(APP_ROOT, filename), DRIVER, **kwargs)
+
+
+class SQLiteStorage:
+    # Writes are grouped into shared commits by a writer thread, see writer.py
+    group_commit = True
+
+    def __init__(self, path):
+        self.path = path
+        self.main = self
+        self.shards = [self]
+        # new games are only inserted on commit, see `next_game_id`
+        self.game_id_lock = threading.Lock()
+        self.last_game_id = 0
+        self.game_locks = [threading.Lock() for i in range(GAME_LOCKS)]
+
+    def shard(self, game_id):
+        return self
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute("PRAGMA foreign_keys = ON")
+        return db
+
+    def release(self, db):
+        db.close()
+
+    def has_table(self, db, name):
+        return bool(
+            db.execute(
+                "SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,)
+            ).fetchone()
+        )
+
+    def lock_schema(self, db):
+        # not needed, SQLite locks the whole file while creating tables
+        pass
+
+    def create_schema(self, db):
+        pass
+
+    def lock_game(self, db, game_id):
+        """Block other requests from changing the game until the request ends
+
+        The writer thread only serializes the writes, so without this two
+        requests could read the same game and the second write would undo
+        the first. Like `next_game_id`, this only works within one process.
+        """
+        lock = self.game_locks[int(game_id) % GAME_LOCKS]
+        lock.acquire()
+        g.setdefault("game_locks", []).append(lock)
+
+    def next_game_id(self, db):
+        row = db.execute("SELECT coalesce(max(game_id), 0) + 1 FROM game").fetchone()
+        # don't hand out the ids of games which are not committed yet
+        with self.game_id_lock:
+            self.last_game_id = max(self.last_game_id + 1, row[0])
+            return self.last_game_id
+
+
+class PostgresStorage:
+    group_commit = False
+
+    def __init__(self, url, max_connections=20):
+        from psycopg2.pool import ThreadedConnectionPool  # type: ignore
+
+        self.pool = ThreadedConnectionPool(1, max_connections, url)
+        # getconn fails right away when all connections are in use
+        self.available = threading.BoundedSemaphore(max_connections)
+        self.main = self
+        self.shards = [self]
+
+    def shard(self, game_id):
+        return self
+
+    def connect(self):
+        if not self.available.acquire(timeout=CONNECT_TIMEOUT):
+            from psycopg2.pool import PoolError
+
+            raise PoolError("No connection available after %ds" % CONNECT_TIMEOUT)
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.available.release()
+            raise
+
+    def release(self, db):
+        try:
+            # discard everything that has not been committed
+            db.rollback()
+            self.pool.putconn(db)
+        finally:
+            self.available.release()
+
+    def has_table(self, db, name):
+        with db.cursor() as cur:
+            cur.execute("SELECT to_regclass(%s)", (name,))
+            return cur.fetchone()[0] is not None
+
+    def lock_schema(self, db):
+        """Wait for other connections creating the tables, until commit
+
+        Concurrent CREATE TABLE IF NOT EXISTS statements can fail.
+        """
+        with db.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (SCHEMA_LOCK_ID,))
+
+    def create_schema(self, db):
+        if self.has_table(db, "game_id_seq"):
+            # setting it again could hand out game_ids which are in use
+            return
+        with db.cursor() as cur:
+            cur.execute(
+                "CREATE SEQUENCE IF NOT EXISTS game_id_seq;"
+                "SELECT setval('game_id_seq', coalesce(max(game_id), 0) + 1, false) "
+                "FROM game"
+            )
+
+    def lock_game(self, db, game_id):
+        """Block other transactions from changing the game until commit"""
+        with db.cursor() as cur:
+            cur.execute("SELECT 1 FROM game WHERE game_id = %s FOR UPDATE", (game_id,))
+
+    def next_game_id(self, db):
+        with db.cursor() as cur:
+            cur.execute("SELECT nextval('game_id_seq')")
+            return cur.fetchone()[0]
+
+
+class ShardedStorage:
+    """Games partitioned by game_id across several SQLite files
+
+    The methods of the single file backend act on the main shard.
+    """
+
+    group_commit = True
+
+    def __init__(self, paths):
+        self.shards = [SQLiteStorage(path) for path in paths]
+        self.main = self.shards[0]
+        self.path = self.main.path
+        self.game_id_lock = threading.Lock()
+        self.last_game_id = 0
+
+    def shard(self, game_id):
+        return self.shards[int(game_id) % len(self.shards)]
+
+    def connect(self):
+        return self.main.connect()
+
+    def release(self, db):
+        self.main.release(db)
+
+    def has_table(self, db, name):
+        return self.main.has_table(db, name)
+
+    def lock_schema(self, db):
+        pass
+
+    def create_schema(self, db):
+        pass
+
+    def lock_game(self, db, game_id):
+        self.shard(game_id).lock_game(db, game_id)
+
+    def next_game_id(self, db):
+        game_ids = []
+        for shard in self.shards:
+            shard_db = shard.connect()
+            game_ids.append(shard.next_game_id(shard_db))
+            shard.release(shard_db)
+        with self.game_id_lock:
+            self.last_game_id = max(self.last_game_id + 1, *game_ids)
+            return self.last_game_id
+
+
+def shard_paths(path, shards):
+    """File names for splitting the SQLite database at `path`"""
+    if shards == 1:
+        return [path]
+    root, ext = os.path.splitext(path)
+    return ["%s-%d-of-%d%s" % (root, i, shards, ext) for i in range(shards)]
+
+
+def create_backend(sqlite_path):
+    if DRIVER == "psycopg2":
+        return PostgresStorage(DATABASE_URL)
+    if SHARDS > 1:
+        return ShardedStorage(shard_paths(sqlite_path, SHARDS))
+    return SQLiteStorage(sqlite_path)
+
+
+def connection(shard):
+    """The request's connection to `shard`, opened on first use"""
+    if shard is g.storage.main:
+        return g.db
+    connections = g.setdefault("connections", {})
+    if shard not in connections:
+        connections[shard] = shard.connect()
+    return connections[shard]
+
+
+def game_db(game_id):
+    """The request's connection to the database holding the game"""
+    return connection(g.storage.shard(game_id))
+
+
+def all_shards(query, **params):
+    """Run `query` on each shard and return the list of results"""
+    return [query(connection(shard), **params) for shard in g.storage.shards]
+
+
+def release_connections():
+    for shard, db in g.pop("connections", {}).items():
+        shard.release(db)
+
+
+def release_game_locks():
+    for lock in g.pop("game_locks", []):
+        lock.release()
@@ -0,0 +1,196 @@
+"""Single writer thread which groups database writes into shared commits
+
+Requests queue their writes with `write` and hand them to the writer with
+`commit`, which blocks until they are committed. The writer executes all
+requests waiting within MAX_DELAY seconds in one transaction, so that bursts
+of requests share a single commit and don't contend for the SQLite lock.
+
+If the writer thread fails outside of a batch, e.g. when it can't open the
+database, the waiting requests get the error and `get_writer` starts a new
+writer. Requests wait at most COMMIT_TIMEOUT seconds for their commit.
+
+Backends without `group_commit` (PostgreSQL) handle concurrent writers
+themselves, so the writes are executed on the request's own connection.
+
+Writes with a `game_id` parameter go to the shard holding that game, all
+others to the main shard. Each shard has its own writer and commits
+separately.
+"""
+
+import time
+import queue
+import logging
+import sqlite3
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from typing import Optional
+
+from flask import g
+
+# Wait this long for more requests before committing a batch
+MAX_DELAY = 0.002
+MAX_BATCH_SIZE = 100
+# Raise an error in the request if its writes take longer than this (in
+# seconds). They might still be committed afterwards.
+COMMIT_TIMEOUT = 60
+# Try this many times, 0.1 seconds apart, to switch the database to WAL mode
+WAL_RETRIES = 300
+
+logger = logging.getLogger(__name__)
+
+_writers: dict = {}
+_writers_lock = threading.Lock()
+
+
+class Writer:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.queue: queue.Queue = queue.Queue()
+        self.batch_sizes: Counter = Counter()
+        self.failed_writes = 0
+        self.commit_time = 0.0
+        # set when the writer thread has stopped
+        self.error: Optional[Exception] = None
+        self.error_lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def submit(self, writes):
+        """Queue a list of (query, params) to be executed in one savepoint
+
+        Returns a future for the list of query results.
+        """
+        future: Future = Future()
+        with self.error_lock:
+            if self.error is None:
+                self.queue.put((writes, future))
+            else:
+                future.set_exception(self.error)
+        return future
+
+    def run(self):
+        batch: list = []
+        try:
+            db = self.connect()
+            while True:
+                batch = [self.queue.get()]
+                deadline = time.monotonic() + MAX_DELAY
+                while len(batch) < MAX_BATCH_SIZE:
+                    try:
+                        timeout = max(deadline - time.monotonic(), 0)
+                        batch.append(self.queue.get(timeout=timeout))
+                    except queue.Empty:
+                        break
+                self.execute_batch(db, batch)
+        except Exception as e:
+            logger.exception("Writer for %s stopped", self.db_path)
+            with self.error_lock:
+                self.error = e
+            for writes, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            # nothing is queued after the error is set
+            while not self.queue.empty():
+                writes, future = self.queue.get()
+                future.set_exception(e)
+
+    def connect(self):
+        db = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+        db.execute("PRAGMA foreign_keys = ON")
+        for i in range(WAL_RETRIES):
+            # doesn't wait for the busy timeout, e.g. while the first
+            # requests are creating the tables
+            try:
+                db.execute("PRAGMA journal_mode = WAL")
+                return db
+            except sqlite3.OperationalError:
+                time.sleep(0.1)
+        db.execute("PRAGMA journal_mode = WAL")
+        return db
+
+    def execute_batch(self, db, batch):
+        start_time = time.perf_counter()
+        results: list = []  # (future, result, exception)
+        try:
+            db.execute("BEGIN IMMEDIATE")
+            for writes, future in batch:
+                # a failing request must not affect the others in the batch
+                db.execute("SAVEPOINT request")
+                try:
+                    result = [query(db, **params) for query, params in writes]
+                except Exception as e:
+                    db.execute("ROLLBACK TO request")
+                    self.failed_writes += 1
+                    results.append((future, None, e))
+                else:
+                    results.append((future, result, None))
+                db.execute("RELEASE request")
+            db.execute("COMMIT")
+        except Exception as e:
+            if db.in_transaction:
+                db.execute("ROLLBACK")
+            results = [(future, None, e) for writes, future in batch]
+
+        self.commit_time += time.perf_counter() - start_time
+        self.batch_sizes[len(batch)] += 1
+        for future, value, error in results:
+            if error is None:
+                future.set_result(value)
+            else:
+                future.set_exception(error)
+
+    def metrics(self):
+        batches = sum(self.batch_sizes.values())
+        return dict(
+            queue_depth=self.queue.qsize(),
+            batches=batches,
+            writes=sum(size * n for size, n in self.batch_sizes.items()),
+            failed_writes=self.failed_writes,
+            batch_sizes=dict(sorted(self.batch_sizes.items())),
+            average_commit_time=self.commit_time / batches if batches else 0,
+        )
+
+
+def get_writer(db_path):
+    with _writers_lock:
+        if db_path not in _writers or _writers[db_path].error is not None:
+            _writers[db_path] = Writer(db_path)
+        return _writers[db_path]
+
+
+def shard_for(params):
+    if "game_id" in params:
+        return g.storage.shard(params["game_id"])
+    return g.storage.main
+
+
+def write(query, **params):
+    """Queue a write to be committed with the next `commit` of this request"""
+    shard_writes = g.setdefault("writes", {}).setdefault(shard_for(params), [])
+    shard_writes.append((query, params))
+
+
+def commit():
+    if not g.storage.group_commit:
+        for query, params in g.pop("writes", {}).get(g.storage, []):
+            query(g.db, **params)
+        g.db.commit()
+        return
+
+    futures = [
+        get_writer(shard.path).submit(writes)
+        for shard, writes in g.pop("writes", {}).items()
+    ]
+    for future in futures:
+        future.result(timeout=COMMIT_TIMEOUT)
+
+
+def execute(query, **params):
+    """Execute a single write right away and return its result"""
+    if not g.storage.group_commit:
+        result = query(g.db, **params)
+        g.db.commit()
+        return result
+    shard = shard_for(params)
+    future = get_writer(shard.path).submit([(query, params)])
+    return future.result(timeout=COMMIT_TIMEOUT)[0]